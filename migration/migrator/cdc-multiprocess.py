@@ -1,30 +1,1013 @@
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import os
 import sys
 import time
 import pymongo
+import bson
+from bson.raw_bson import RawBSONDocument
+from bson.codec_options import CodecOptions
 from bson.timestamp import Timestamp
+from bson.objectid import ObjectId
 import threading
+import queue
 import multiprocessing as mp
+import multiprocessing.connection
+import json
+import re
 import hashlib
+import zlib
+import gzip
+import bisect
+import itertools
+import math
 import argparse
 
 
+# layout of each worker's slot in the shared metrics arrays
+METRIC_OPERATIONS = 0
+METRIC_APPLIED_OPERATIONS = 1
+METRIC_BYTES = 2
+METRIC_BATCHES = 3
+METRIC_TS_TIME = 4
+METRIC_TS_INC = 5
+METRIC_BATCH_OPS = 6
+METRIC_COMPLETED = 7
+METRIC_BATCH_SECONDS = 8
+METRIC_BATCH_LATENCY = 9
+
+# upper bound in milliseconds of each batch latency histogram bucket, one more bucket holds everything slower
+BATCH_LATENCY_BUCKETS_MS = [1,2,5,10,25,50,100,250,500,1000,2500,5000,10000]
+
+METRIC_LATENCY = METRIC_BATCH_LATENCY + len(BATCH_LATENCY_BUCKETS_MS) + 1
+
+# end-to-end latency histogram, log-linear like HDR histograms: bucket 0 is under 1 ms, then each power of two
+# from 1 ms is split into LATENCY_SUB_BUCKETS equal buckets (about 6 percent precision), the last bucket holds everything over 2^LATENCY_MAX_EXPONENT ms
+LATENCY_SUB_BUCKETS = 16
+LATENCY_MAX_EXPONENT = 24
+LATENCY_BUCKETS = 1 + LATENCY_MAX_EXPONENT * LATENCY_SUB_BUCKETS + 1
+
+METRIC_SLOT_SIZE = METRIC_LATENCY + LATENCY_BUCKETS
+
+RESUME_TOKEN_BYTES = 1024
+
+# oplog entry fields the reader and workers use, everything else (ui, prevOpTime, ...) is left on the server
+# lsid and txnNumber identify the transaction a partialTxn, prepare, or commitTransaction entry belongs to
+OPLOG_PROJECTION = {'ts':1,'wall':1,'op':1,'ns':1,'o':1,'o2':1,'lsid':1,'txnNumber':1}
+
+
 def logIt(threadnum, message):
     logTimeStamp = datetime.utcnow().isoformat()[:-3] + 'Z'
     print("[{}] thread {:>3d} | {}".format(logTimeStamp,threadnum,message))
 
 
-def oplog_processor(threadnum, appConfig, perfQ):
+def create_metrics(numWorkers):
+    # one shared array of counters per worker plus a resume token buffer guarded by the same lock
+    # workers publish into their own slot and the reporter reads them directly, there is no server process in between
+    metrics = []
+    for x in range(numWorkers):
+        metrics.append((mp.Array('d',METRIC_SLOT_SIZE),mp.Array('c',RESUME_TOKEN_BYTES,lock=False)))
+    return metrics
+
+
+def get_latency_bucket(latencyMs):
+    if (latencyMs < 1):
+        return 0
+    exponent = int(math.log2(latencyMs))
+    if (exponent >= LATENCY_MAX_EXPONENT):
+        return LATENCY_BUCKETS - 1
+    return 1 + exponent * LATENCY_SUB_BUCKETS + int((latencyMs / 2**exponent - 1) * LATENCY_SUB_BUCKETS)
+
+
+def get_latency_bucket_ms(bucketNum):
+    # highest latency in milliseconds counted by a bucket
+    if (bucketNum == 0):
+        return 1
+    if (bucketNum >= LATENCY_BUCKETS - 1):
+        return float(2**LATENCY_MAX_EXPONENT)
+    exponent, subBucket = divmod(bucketNum - 1, LATENCY_SUB_BUCKETS)
+    return 2**exponent * (1 + (subBucket + 1) / LATENCY_SUB_BUCKETS)
+
+
+def get_latency_percentiles(latencyCounts, percentileList):
+    # value at each percentile of a latency histogram, in milliseconds, None when it is empty
+    totalCount = sum(latencyCounts)
+    if (totalCount == 0):
+        return [None for thisPercentile in percentileList]
+
+    percentileValues = []
+    for thisPercentile in percentileList:
+        targetCount = max(1, math.ceil(totalCount * thisPercentile / 100))
+        cumulativeCount = 0
+        for bucketNum, bucketCount in enumerate(latencyCounts):
+            cumulativeCount += bucketCount
+            if (cumulativeCount >= targetCount):
+                percentileValues.append(get_latency_bucket_ms(bucketNum))
+                break
+    return percentileValues
+
+
+def get_source_seconds(wallTime, ts):
+    # when an operation happened on the source in epoch seconds
+    # wall clock time has millisecond precision (oplog "wall" and change stream "wallTime", MongoDB 4.2 and 6.0), ts only has seconds
+    if (wallTime is not None):
+        return wallTime.replace(tzinfo=timezone.utc).timestamp()
+    return ts.time
+
+
+def publish_batch(workerMetrics, numOps, numAppliedOps, numBytes, batchSeconds, batchOps, sourceSecondsList):
+    # sourceSecondsList holds the source time of each operation in the batch, the batch was acknowledged by the target just now
+    ackSeconds = time.time()
+    latencyCounts = {}
+    for sourceSeconds in sourceSecondsList:
+        bucketNum = get_latency_bucket((ackSeconds - sourceSeconds) * 1000)
+        latencyCounts[bucketNum] = latencyCounts.get(bucketNum,0) + 1
+
+    metricValues, resumeTokenBuffer = workerMetrics
+    with metricValues.get_lock():
+        rawValues = metricValues.get_obj()
+        rawValues[METRIC_OPERATIONS] += numOps
+        rawValues[METRIC_APPLIED_OPERATIONS] += numAppliedOps
+        rawValues[METRIC_BYTES] += numBytes
+        rawValues[METRIC_BATCHES] += 1
+        rawValues[METRIC_BATCH_OPS] = batchOps
+        rawValues[METRIC_BATCH_SECONDS] += batchSeconds
+        rawValues[METRIC_BATCH_LATENCY + bisect.bisect_left(BATCH_LATENCY_BUCKETS_MS,batchSeconds * 1000)] += 1
+        for bucketNum, bucketCount in latencyCounts.items():
+            rawValues[METRIC_LATENCY + bucketNum] += bucketCount
+
+
+def publish_position(workerMetrics, endTs, resumeToken=None):
+    # everything routed to the worker at or before endTs has been applied
+    metricValues, resumeTokenBuffer = workerMetrics
+    with metricValues.get_lock():
+        rawValues = metricValues.get_obj()
+        rawValues[METRIC_TS_TIME] = endTs.time
+        rawValues[METRIC_TS_INC] = endTs.inc
+        if (resumeToken is not None) and (len(resumeToken) < RESUME_TOKEN_BYTES):
+            resumeTokenBuffer.value = resumeToken.encode('utf-8')
+
+
+def publish_completed(workerMetrics):
+    metricValues, resumeTokenBuffer = workerMetrics
+    with metricValues.get_lock():
+        metricValues.get_obj()[METRIC_COMPLETED] = 1
+
+
+def read_metrics(metrics):
+    # consistent copy of every worker's slot as (values, resume token)
+    metricsSnapshot = []
+    for metricValues, resumeTokenBuffer in metrics:
+        with metricValues.get_lock():
+            metricsSnapshot.append((list(metricValues.get_obj()),resumeTokenBuffer.value.decode('utf-8')))
+    return metricsSnapshot
+
+
+def export_metrics(appConfig, metricsSnapshot):
+    # snapshot of every worker's counters as Prometheus text (rewritten each time) or JSON lines (appended)
+    # workers are numbered target by target, maxProcessingThreads each
+    if (appConfig['metricsFormat'] == 'json'):
+        workerList = []
+        for workerNum, (thisValues, thisResumeToken) in enumerate(metricsSnapshot):
+            workerList.append({'worker':workerNum,
+                               'target':workerNum // appConfig['maxProcessingThreads'],
+                               'operations':int(thisValues[METRIC_OPERATIONS]),
+                               'appliedOperations':int(thisValues[METRIC_APPLIED_OPERATIONS]),
+                               'bytes':int(thisValues[METRIC_BYTES]),
+                               'batches':int(thisValues[METRIC_BATCHES]),
+                               'batchOps':int(thisValues[METRIC_BATCH_OPS]),
+                               'batchSeconds':thisValues[METRIC_BATCH_SECONDS],
+                               'ts':{'t':int(thisValues[METRIC_TS_TIME]),'i':int(thisValues[METRIC_TS_INC])},
+                               'resumeToken':thisResumeToken,
+                               'completed':bool(thisValues[METRIC_COMPLETED]),
+                               'batchLatencyBucketsMs':BATCH_LATENCY_BUCKETS_MS,
+                               'batchLatencyCounts':[int(x) for x in thisValues[METRIC_BATCH_LATENCY:METRIC_LATENCY]]})
+        with open(appConfig['metricsFile'], 'a') as fp:
+            fp.write(json.dumps({'time':datetime.utcnow().isoformat()[:-3] + 'Z','workers':workerList}) + '\n')
+
+    else:
+        metricLines = []
+        for metricName, metricType, metricIndex in [('cdc_operations_total','counter',METRIC_OPERATIONS),
+                                                    ('cdc_applied_operations_total','counter',METRIC_APPLIED_OPERATIONS),
+                                                    ('cdc_bytes_total','counter',METRIC_BYTES),
+                                                    ('cdc_batches_total','counter',METRIC_BATCHES),
+                                                    ('cdc_batch_operations','gauge',METRIC_BATCH_OPS),
+                                                    ('cdc_applied_timestamp_seconds','gauge',METRIC_TS_TIME)]:
+            metricLines.append('# TYPE {} {}'.format(metricName,metricType))
+            for workerNum, (thisValues, thisResumeToken) in enumerate(metricsSnapshot):
+                metricLines.append('{}{{worker="{}",target="{}"}} {}'.format(metricName,workerNum,workerNum // appConfig['maxProcessingThreads'],repr(thisValues[metricIndex])))
+
+        metricLines.append('# TYPE cdc_batch_latency_seconds histogram')
+        for workerNum, (thisValues, thisResumeToken) in enumerate(metricsSnapshot):
+            targetNum = workerNum // appConfig['maxProcessingThreads']
+            cumulativeCount = 0
+            for bucketNum, bucketMs in enumerate(BATCH_LATENCY_BUCKETS_MS + ['+Inf']):
+                cumulativeCount += int(thisValues[METRIC_BATCH_LATENCY + bucketNum])
+                bucketLabel = bucketMs if bucketMs == '+Inf' else repr(bucketMs / 1000)
+                metricLines.append('cdc_batch_latency_seconds_bucket{{worker="{}",target="{}",le="{}"}} {}'.format(workerNum,targetNum,bucketLabel,cumulativeCount))
+            metricLines.append('cdc_batch_latency_seconds_sum{{worker="{}",target="{}"}} {}'.format(workerNum,targetNum,repr(thisValues[METRIC_BATCH_SECONDS])))
+            metricLines.append('cdc_batch_latency_seconds_count{{worker="{}",target="{}"}} {}'.format(workerNum,targetNum,cumulativeCount))
+
+        # write a temporary file and rename it so a scraper never sees a partial file
+        tempFileName = appConfig['metricsFile'] + '.tmp'
+        with open(tempFileName, 'w') as fp:
+            fp.write('\n'.join(metricLines) + '\n')
+        os.replace(tempFileName, appConfig['metricsFile'])
+
+
+def get_partitioner(appConfig, numWorkers=None):
+    # returns a function mapping a document _id to the number of the worker that owns it, out of numWorkers (defaults to --threads)
+    # NOTE: Python's non-deterministic hash() cannot be used as it is seeded at startup, since this code is multiprocessing we need all hash calls to be the same between processes
+    if numWorkers is None:
+        numWorkers = appConfig["numProcessingThreads"]
+
+    if (appConfig["partitioner"] == 'sha512'):
+        # original scheme, cryptographic hash of the string form of the _id
+        def partitionOf(docId):
+            return int(hashlib.sha512(str(docId).encode('utf-8')).hexdigest(), 16) % numWorkers
+    else:
+        # crc32 of the BSON encoding of the _id, stable across processes and Python versions
+        def partitionOf(docId):
+            if type(docId) is ObjectId:
+                # BSON type byte plus the 12 byte value, avoids building a document for the common case
+                return zlib.crc32(b'\x07' + docId.binary) % numWorkers
+            if type(docId) is RawBSONDocument:
+                # embedded document _id as read by the reader, the same bytes bson.encode would produce without re-encoding it
+                return zlib.crc32((len(docId.raw) + 10).to_bytes(4,'little') + b'\x03_id\x00' + docId.raw + b'\x00') % numWorkers
+            return zlib.crc32(bson.encode({'_id':docId})) % numWorkers
+
+    return partitionOf
+
+
+class BatchSizer:
+    # decides how many operations go into the next bulk_write
+    # fixed at --max-operations-per-batch unless --adaptive-batching is enabled, then steered by observed latency, size and errors
+
+    def __init__(self, appConfig, initialOps):
+        self.adaptive = appConfig['adaptiveBatching']
+        self.batchOps = initialOps
+        self.minOps = 1
+        if self.adaptive:
+            self.maxOps = max(initialOps,appConfig['adaptiveMaxOperations'])
+        else:
+            self.maxOps = initialOps
+        self.targetSeconds = appConfig['targetBatchMs'] / 1000.0
+        self.maxBytes = appConfig['maxBatchBytes']
+
+    def isFull(self, numOps, numBytes):
+        if (numOps >= self.batchOps):
+            return True
+        return self.adaptive and (numBytes >= self.maxBytes)
+
+    def record(self, numOps, numBytes, elapsedSeconds, failed):
+        # returns True if the batch size changed
+        if not self.adaptive:
+            return False
+
+        previousOps = self.batchOps
+
+        if failed:
+            # target is struggling, back off hard
+            self.batchOps = max(self.minOps, self.batchOps // 2)
+        elif (elapsedSeconds > self.targetSeconds * 1.25):
+            # too slow, scale towards the target latency but never below half
+            scaledOps = int(numOps * self.targetSeconds / elapsedSeconds)
+            self.batchOps = max(self.minOps, self.batchOps // 2, min(self.batchOps, scaledOps))
+        elif (numOps >= self.batchOps) and (elapsedSeconds < self.targetSeconds * 0.75) and (numBytes < self.maxBytes * 0.75):
+            # full batch with headroom on latency and size, grow
+            self.batchOps = min(self.maxOps, int(self.batchOps * 1.25) + 1)
+
+        return (self.batchOps != previousOps)
+
+
+class ByteBudget:
+    # bytes read from the source and queued for a worker but not yet taken off the queue
+    # the reader waits while the budget is used up, so a slow target holds back reading instead of growing memory
+    # also tracks whether a message carrying only the reader's position is queued, the reader never queues a second one
+    # workerFailed is shared by every budget, set by the main process when a worker or the reader exits with an error
+
+    def __init__(self, maxBytes, workerFailed):
+        self.maxBytes = maxBytes
+        self.usedBytes = mp.Value('q',0,lock=False)
+        self.positionQueued = mp.Value('b',0,lock=False)
+        self.condition = mp.Condition()
+        self.workerFailed = workerFailed
+
+    def acquire(self, numBytes):
+        # returns False without taking the bytes if a worker failed while waiting, it will never release the budget
+        with self.condition:
+            # a message larger than the whole budget is let through once everything before it has been taken
+            while (self.usedBytes.value > 0) and (self.usedBytes.value + numBytes > self.maxBytes):
+                if (self.workerFailed.value == 1):
+                    return False
+                self.condition.wait(timeout=1)
+            self.usedBytes.value += numBytes
+            return True
+
+    def queue_position(self):
+        # returns False when the worker has not yet taken the previous position-only message
+        with self.condition:
+            if (self.positionQueued.value == 1):
+                return False
+            self.positionQueued.value = 1
+            return True
+
+    def release(self, numBytes):
+        with self.condition:
+            self.usedBytes.value -= numBytes
+            if (numBytes == 0):
+                # a message without entries was taken, there is no position-only message ahead of the next one
+                self.positionQueued.value = 0
+            self.condition.notify_all()
+
+
+class TransactionHold:
+    # keeps the checkpoint at or before the first oplog entry of any transaction the reader is buffering or whose operations may not be applied yet
+    # a restart from a later position would find the commit without the partialTxn or prepare entries before it
+    # each transaction is held from its first entry until every worker has applied its commit, so a steady stream of transactions still lets the checkpoint advance
+    # the reader keeps the transactions and publishes the oldest first entry, the reporter publishes the position every worker has applied
+    # timestamps are stored as (time << 32) + inc so each is a single value, 0 = none
+
+    def __init__(self):
+        # first entry of the oldest transaction held, position every worker has applied
+        self.values = mp.Array('q',2)
+        # reader only, first entry of each open transaction and (first entry, commit) of each committed one not yet applied
+        self.openTxns = {}
+        self.committedTxns = []
+
+    def open(self, txnKey, txnTs):
+        self.openTxns[txnKey] = (txnTs.time << 32) + txnTs.inc
+        self.publish()
+
+    def close(self, txnKey, commitTs):
+        # commitTs is None for an aborted transaction, nothing of it is applied
+        firstTs = self.openTxns.pop(txnKey)
+        if (commitTs is not None):
+            self.committedTxns.append((firstTs,(commitTs.time << 32) + commitTs.inc))
+        self.publish()
+
+    def publish(self):
+        # called by the reader, releases every transaction applied up to its commit
+        with self.values.get_lock():
+            self.committedTxns = [thisTxn for thisTxn in self.committedTxns if thisTxn[1] > self.values[1]]
+            firstTsList = list(self.openTxns.values()) + [thisTxn[0] for thisTxn in self.committedTxns]
+            self.values[0] = min(firstTsList) if (len(firstTsList) > 0) else 0
+
+    def get_limit(self, appliedTs):
+        # appliedTs is the position every worker has applied, returns the position the checkpoint cannot pass or None
+        # transactions applied by now are released the next time the reader publishes
+        with self.values.get_lock():
+            self.values[1] = max(self.values[1],(appliedTs.time << 32) + appliedTs.inc)
+            if (self.values[0] == 0):
+                return None
+            return Timestamp(self.values[0] >> 32,self.values[0] & 0xffffffff)
+
+
+class TransactionBuffer:
+    # unpacks transactions in the oplog into one entry per operation, as if each had been written outside a transaction
+    # small transactions are a single applyOps entry, larger ones are a chain of partialTxn entries ending with the applyOps that commits
+    # prepared transactions (sharded clusters) end with a separate commitTransaction or abortTransaction entry
+
+    def __init__(self, appConfig, txnHold):
+        self.nsPattern = re.compile(get_namespace_pattern(appConfig))
+        self.txnHold = txnHold
+        # operations of open transactions by session and transaction number
+        self.openTxns = {}
+
+    def add(self, doc):
+        # returns the entries to route for a command entry, empty until a transaction commits
+        if ('lsid' in doc) and ('txnNumber' in doc):
+            txnKey = (doc['lsid'].raw,doc['txnNumber'])
+        else:
+            # applyOps outside a transaction
+            txnKey = None
+
+        if ('applyOps' in doc['o']):
+            isPartial = doc['o'].get('partialTxn',False) or doc['o'].get('prepare',False)
+            if (txnKey is None) or ((txnKey not in self.openTxns) and not isPartial):
+                # a single entry transaction is read in one piece, nothing to hold
+                return self.get_entries(doc,doc['o']['applyOps'])
+            if (txnKey not in self.openTxns):
+                self.openTxns[txnKey] = []
+                self.txnHold.open(txnKey,doc['ts'])
+            self.openTxns[txnKey].extend(doc['o']['applyOps'])
+            if isPartial:
+                return []
+            return self.commit(txnKey,doc)
+
+        elif ('commitTransaction' in doc['o']) and (txnKey in self.openTxns):
+            return self.commit(txnKey,doc)
+
+        elif ('abortTransaction' in doc['o']) and (txnKey in self.openTxns):
+            del self.openTxns[txnKey]
+            self.txnHold.close(txnKey,None)
+
+        return []
+
+    def commit(self, txnKey, doc):
+        innerOps = self.openTxns.pop(txnKey)
+        self.txnHold.close(txnKey,doc['ts'])
+        return self.get_entries(doc,innerOps)
+
+    def get_entries(self, doc, innerOps):
+        # every operation takes the position of the entry that committed it, in the order it was made
+        # commands within a transaction (creating a collection) are not replicated
+        entryList = []
+        for innerOp in innerOps:
+            if (innerOp['op'] in ['i','u','d']) and (self.nsPattern.match(innerOp['ns']) is not None):
+                thisEntry = {'ts':doc['ts'],'op':innerOp['op'],'ns':innerOp['ns'],'o':innerOp['o']}
+                if ('wall' in doc):
+                    thisEntry['wall'] = doc['wall']
+                if ('o2' in innerOp):
+                    thisEntry['o2'] = innerOp['o2']
+                entryList.append(RawBSONDocument(bson.encode(thisEntry)))
+        return entryList
+
+
+def get_document_id(doc):
+    # _id of a document, raw documents are not decoded when the _id is a leading ObjectId (the server stores _id first)
+    if isinstance(doc,RawBSONDocument):
+        rawBytes = doc.raw
+        if (rawBytes[4:9] == b'\x07_id\x00'):
+            return ObjectId(rawBytes[9:21])
+    return doc['_id']
+
+
+def get_delta_update(updateDescription):
+    # $set/$unset/$push update equivalent to a change stream updateDescription, None if it cannot be expressed as one
+    updatedFields = updateDescription.get('updatedFields',{})
+    removedFields = updateDescription.get('removedFields',[])
+    truncatedArrays = updateDescription.get('truncatedArrays',[])
+
+    if ('disambiguatedPaths' in updateDescription):
+        # 6.1+ with expanded events lists every path with field names containing dots or digits only, the dotted paths would address the wrong fields
+        if (len(updateDescription['disambiguatedPaths']) > 0):
+            return None
+    else:
+        # older servers do not say, a numeric part may be a field name rather than an array index
+        for thisPath in list(updatedFields) + list(removedFields) + [thisArray['field'] for thisArray in truncatedArrays]:
+            for thisPart in thisPath.split('.'):
+                if (thisPart == '') or thisPart.isdigit() or thisPart.startswith('$'):
+                    return None
+
+    updateDoc = {}
+    if (len(updatedFields) > 0):
+        updateDoc['$set'] = dict(updatedFields)
+    if (len(removedFields) > 0):
+        updateDoc['$unset'] = {thisPath: 1 for thisPath in removedFields}
+    if (len(truncatedArrays) > 0):
+        # an empty $push with $slice keeps the first newSize elements
+        updateDoc['$push'] = {}
+        for thisArray in truncatedArrays:
+            for thisPath in list(updatedFields) + list(removedFields):
+                if (thisPath == thisArray['field']) or thisPath.startswith(thisArray['field'] + '.'):
+                    # elements of the truncated array are also set, both cannot be in one update
+                    return None
+            updateDoc['$push'][thisArray['field']] = {'$each': [], '$slice': thisArray['newSize']}
+
+    return updateDoc
+
+
+def get_id_key(docId):
+    # hashable stand-in for an _id, used to find operations on the same document
+    # True and 1 (False and 0) are equal in Python but different _id values, 1 and 1.0 are the same _id like on the server
+    try:
+        hash(docId)
+        return (isinstance(docId,bool),docId)
+    except TypeError:
+        # embedded document _id values
+        return (None,bson.encode({'_id':docId}))
+
+
+def get_diff_update(diffDoc, pathPrefix, updateDoc, truncatedArrays):
+    # adds the $set/$unset equivalent of a "$v":2 oplog diff to updateDoc, arrays to shorten go in truncatedArrays as (path, new size)
+    # returns False if the diff cannot be expressed with dotted paths (field names containing dots or starting with $)
+    if (diffDoc.get('a',None) is True):
+        # array, u<index> replaces an element, s<index> is a diff of one, l is the new length
+        for thisKey, thisValue in diffDoc.items():
+            if (thisKey == 'a'):
+                continue
+            elif (thisKey == 'l'):
+                truncatedArrays.append((pathPrefix[:-1],thisValue))
+            elif thisKey.startswith('u'):
+                updateDoc['$set'][pathPrefix + thisKey[1:]] = thisValue
+            elif thisKey.startswith('s'):
+                if not get_diff_update(thisValue,pathPrefix + thisKey[1:] + '.',updateDoc,truncatedArrays):
+                    return False
+            else:
+                return False
+        return True
+
+    # document, i and u set fields, d removes them, s<field> is a diff of one
+    for thisKey, thisValue in diffDoc.items():
+        if thisKey.startswith('s'):
+            fieldList = [thisKey[1:]]
+        elif (thisKey in ['i','u','d']):
+            fieldList = list(thisValue.keys())
+        else:
+            return False
+        for thisField in fieldList:
+            if (thisField == '') or ('.' in thisField) or thisField.startswith('$'):
+                return False
+
+        if (thisKey in ['i','u']):
+            for thisField, thisFieldValue in thisValue.items():
+                updateDoc['$set'][pathPrefix + thisField] = thisFieldValue
+        elif (thisKey == 'd'):
+            for thisField in thisValue.keys():
+                updateDoc['$unset'][pathPrefix + thisField] = 1
+        else:
+            if not get_diff_update(thisValue,pathPrefix + thisKey[1:] + '.',updateDoc,truncatedArrays):
+                return False
+    return True
+
+
+def get_oplog_bulk_ops(doc):
+    # list of (type, _id, filter, document or update) for an insert, update, or delete oplog entry, None if it cannot be applied
+    if (doc['op'] == 'i'):
+        docId = get_document_id(doc['o'])
+        return [('i',docId,{'_id':docId},doc['o'])]
+
+    elif (doc['op'] == 'u'):
+        # field "$v" is not present in MongoDB 3.4
+        updateVersion = doc['o'].get('$v',None)
+        if (updateVersion != 2) and not any(thisKey.startswith('$') for thisKey in doc['o'] if thisKey != '$v'):
+            # full document replacement
+            return [('r',doc['o2']['_id'],doc['o2'],doc['o'])]
+        if (updateVersion == 2):
+            # 5.0+ records updates as a diff, which is not an update the server accepts
+            updateDoc = {'$set':{},'$unset':{}}
+            truncatedArrays = []
+            if not get_diff_update(doc['o']['diff'],'',updateDoc,truncatedArrays):
+                return None
+            # shortening an array cannot be in the same update as setting its elements, each is applied first on its own
+            bulkOpList = [('u',doc['o2']['_id'],doc['o2'],{'$push':{thisPath:{'$each':[],'$slice':newSize}}}) for thisPath, newSize in truncatedArrays]
+            updateDoc = {thisOperator: thisFields for thisOperator, thisFields in updateDoc.items() if (len(thisFields) > 0)}
+            if (len(updateDoc) > 0):
+                bulkOpList.append(('u',doc['o2']['_id'],doc['o2'],updateDoc))
+            return bulkOpList
+        # copied without "$v", raw documents cannot be modified
+        updateDoc = {thisKey: thisValue for thisKey, thisValue in doc['o'].items() if thisKey != '$v'}
+        return [('u',doc['o2']['_id'],doc['o2'],updateDoc)]
+
+    return [('d',doc['o']['_id'],doc['o'],None)]
+
+
+def build_bulk_op(bulkOp, replaceForm):
+    # replaceForm turns an insert into an upsert, for when the document already exists (replaying old oplog)
+    opType, docId, opFilter, opPayload = bulkOp
+    if (opType == 'i'):
+        if replaceForm:
+            return pymongo.ReplaceOne(opFilter,opPayload,upsert=True)
+        return pymongo.InsertOne(opPayload)
+    elif (opType == 'r'):
+        return pymongo.ReplaceOne(opFilter,opPayload,upsert=True)
+    elif (opType == 'u'):
+        return pymongo.UpdateOne(opFilter,opPayload,upsert=False)
+    else:
+        return pymongo.DeleteOne(opFilter)
+
+
+def fold_update(fullDoc, updateDoc):
+    # returns fullDoc with updateDoc applied, or None if the update cannot be applied locally
+    if not set(updateDoc.keys()) <= {'$set','$unset'}:
+        return None
+    for thisOperator in updateDoc:
+        for thisPath in updateDoc[thisOperator]:
+            # only top-level fields, dotted paths may address array elements
+            if ('.' in thisPath) or (thisPath == '_id'):
+                return None
+
+    foldedDoc = dict(fullDoc)
+    for thisPath, thisValue in updateDoc.get('$set',{}).items():
+        foldedDoc[thisPath] = thisValue
+    for thisPath in updateDoc.get('$unset',{}):
+        foldedDoc.pop(thisPath,None)
+    return foldedDoc
+
+
+def merge_updates(firstUpdate, secondUpdate):
+    # returns one update equivalent to firstUpdate followed by secondUpdate, or None if they cannot be combined
+    if not (set(firstUpdate.keys()) <= {'$set','$unset'}) or not (set(secondUpdate.keys()) <= {'$set','$unset'}):
+        return None
+
+    mergedUpdate = {'$set':dict(firstUpdate.get('$set',{})),'$unset':dict(firstUpdate.get('$unset',{}))}
+    for thisOperator in ['$set','$unset']:
+        for thisPath, thisValue in secondUpdate.get(thisOperator,{}).items():
+            for existingPath in list(mergedUpdate['$set']) + list(mergedUpdate['$unset']):
+                if existingPath.startswith(thisPath + '.') or thisPath.startswith(existingPath + '.'):
+                    # parent and child paths in one update conflict
+                    return None
+            # the later operation on the same path wins
+            mergedUpdate['$set'].pop(thisPath,None)
+            mergedUpdate['$unset'].pop(thisPath,None)
+            mergedUpdate[thisOperator][thisPath] = thisValue
+
+    for thisOperator in ['$set','$unset']:
+        if (len(mergedUpdate[thisOperator]) == 0):
+            del mergedUpdate[thisOperator]
+    return mergedUpdate
+
+
+def coalesce_key_ops(keyOps):
+    # collapse the operations on a single _id into the fewest with the same end result
+    # everything before the last insert, replace, or delete is overwritten by it
+    lastFullOp = 0
+    for opNum in range(len(keyOps)):
+        if keyOps[opNum][0] in ['i','r','d']:
+            lastFullOp = opNum
+
+    coalescedOps = [keyOps[lastFullOp]]
+    for bulkOp in keyOps[lastFullOp+1:]:
+        previousOp = coalescedOps[-1]
+        if (previousOp[0] in ['i','r']):
+            foldedDoc = fold_update(previousOp[3],bulkOp[3])
+            if foldedDoc is not None:
+                coalescedOps[-1] = (previousOp[0],previousOp[1],previousOp[2],foldedDoc)
+                continue
+        elif (previousOp[0] == 'u'):
+            mergedUpdate = merge_updates(previousOp[3],bulkOp[3])
+            if mergedUpdate is not None:
+                coalescedOps[-1] = ('u',previousOp[1],previousOp[2],mergedUpdate)
+                continue
+        elif (previousOp[0] == 'd'):
+            # updating a deleted document matches nothing
+            continue
+        coalescedOps.append(bulkOp)
+
+    return coalescedOps
+
+
+def coalesce_ops(bulkOps):
+    # operations on different _id values are independent, only the order within each _id is kept
+    opsByKey = {}
+    for bulkOp in bulkOps:
+        opsByKey.setdefault(get_id_key(bulkOp[1]),[]).append(bulkOp)
+
+    coalescedOps = []
+    for keyOps in opsByKey.values():
+        coalescedOps.extend(coalesce_key_ops(keyOps))
+    return coalescedOps
+
+
+def split_by_key(bulkOps):
+    # round N holds the Nth operation on each _id, so no _id appears twice in a round
+    # applying the rounds one after another keeps the per-_id order while each round can run unordered
+    rounds = []
+    opsPerKey = {}
+    for bulkOp in bulkOps:
+        idKey = get_id_key(bulkOp[1])
+        roundNum = opsPerKey.get(idKey,0)
+        opsPerKey[idKey] = roundNum + 1
+        if (roundNum == len(rounds)):
+            rounds.append([])
+        rounds[roundNum].append(bulkOp)
+    return rounds
+
+
+def apply_bulk_ops(appConfig, destCollection, bulkOps):
+    # returns the seconds spent applying, whether the first attempt failed for a reason other than a write error, and the number of operations sent
+    batchStartTime = time.time()
+    batchFailed = False
+
+    if appConfig['coalesceOps']:
+        bulkOps = coalesce_ops(bulkOps)
+
+    if appConfig['dryRun']:
+        pass
+
+    elif appConfig['unorderedApply']:
+        for roundOps in split_by_key(bulkOps):
+            try:
+                result = destCollection.bulk_write([build_bulk_op(bulkOp,False) for bulkOp in roundOps],ordered=False)
+            except pymongo.errors.BulkWriteError as bwe:
+                if (len(bwe.details['writeErrors']) == 0) or (len(bwe.details.get('writeConcernErrors',[])) > 0):
+                    # the write concern failed, unknown how much was applied, everything is resent in the idempotent form
+                    batchFailed = True
+                    failedOpList = [build_bulk_op(bulkOp,True) for bulkOp in roundOps]
+                else:
+                    # everything else in the round was applied, replace the failed inserts as replaces
+                    failedOpList = [build_bulk_op(roundOps[writeError['index']],True) for writeError in bwe.details['writeErrors']]
+                result = destCollection.bulk_write(failedOpList,ordered=False)
+            except pymongo.errors.PyMongoError:
+                # unknown how much was applied, everything is resent in the idempotent form
+                batchFailed = True
+                result = destCollection.bulk_write([build_bulk_op(bulkOp,True) for bulkOp in roundOps],ordered=False)
+
+    else:
+        try:
+            result = destCollection.bulk_write([build_bulk_op(bulkOp,False) for bulkOp in bulkOps],ordered=True)
+        except pymongo.errors.BulkWriteError as bwe:
+            if (len(bwe.details['writeErrors']) == 0) or (len(bwe.details.get('writeConcernErrors',[])) > 0):
+                # the write concern failed, unknown how much was applied, everything is resent in the idempotent form
+                batchFailed = True
+                firstFailedOp = 0
+            else:
+                # an ordered bulk_write stops at the first error, everything before it was applied
+                # if playing old oplog the remaining inserts are likely to fail as well, send the rest with inserts as replaces
+                firstFailedOp = bwe.details['writeErrors'][0]['index']
+            result = destCollection.bulk_write([build_bulk_op(bulkOp,True) for bulkOp in bulkOps[firstFailedOp:]],ordered=True)
+        except pymongo.errors.PyMongoError:
+            # unknown how much was applied, everything is resent in the idempotent form
+            batchFailed = True
+            result = destCollection.bulk_write([build_bulk_op(bulkOp,True) for bulkOp in bulkOps],ordered=True)
+
+    return time.time() - batchStartTime, batchFailed, len(bulkOps)
+
+
+def apply_namespace_bulk_ops(appConfig, destConnection, bulkOpsByNs):
+    # operations are kept per source namespace, each list is applied to its own target collection
+    # returns the same as apply_bulk_ops, summed over the namespaces
+    totalSeconds = 0.0
+    anyFailed = False
+    totalAppliedOps = 0
+
+    for sourceNs, bulkOps in bulkOpsByNs.items():
+        targetNs = get_target_ns(appConfig,sourceNs)
+        destCollection = destConnection[targetNs.split('.',1)[0]][targetNs.split('.',1)[1]]
+        batchSeconds, batchFailed, numAppliedOps = apply_bulk_ops(appConfig,destCollection,bulkOps)
+        totalSeconds += batchSeconds
+        anyFailed = anyFailed or batchFailed
+        totalAppliedOps += numAppliedOps
+
+    return totalSeconds, anyFailed, totalAppliedOps
+
+
+def apply_transaction(appConfig, destConnection, entryList):
+    # applies the operations of one source transaction as a single target transaction, in their original order, returns the seconds spent
+    # inserts are sent as upserts so a transaction replayed after a restart still commits
+    txnStartTime = time.time()
+
+    if appConfig['dryRun']:
+        return 0.0
+
+    def apply_callback(session):
+        # consecutive operations on the same namespace go in one bulk_write
+        for sourceNs, nsEntries in itertools.groupby(entryList,key=lambda x: x['ns']):
+            targetNs = get_target_ns(appConfig,sourceNs)
+            destCollection = destConnection[targetNs.split('.',1)[0]][targetNs.split('.',1)[1]]
+            bulkOpList = []
+            for thisEntry in nsEntries:
+                entryBulkOps = get_oplog_bulk_ops(thisEntry)
+                if (entryBulkOps is None):
+                    logIt(-1,"oplog update at timestamp {} cannot be applied, a changed field name contains a dot or starts with $, use --use-change-stream".format(thisEntry['ts'].as_datetime()))
+                    sys.exit(1)
+                bulkOpList.extend([build_bulk_op(bulkOp,True) for bulkOp in entryBulkOps])
+            destCollection.bulk_write(bulkOpList,ordered=True,session=session)
+
+    with destConnection.start_session() as session:
+        # retried by the driver on transient errors and unknown commit results
+        session.with_transaction(apply_callback)
+
+    return time.time() - txnStartTime
+
+
+def get_namespace_pattern(appConfig):
+    # regular expression matching every source namespace to replicate, used for the oplog query and by every Python check
+    # a --source-namespace-regex has to match the whole namespace, the same on the server and in Python
+    if (appConfig['sourceNsRegex'] is not None):
+        return '^(?:' + appConfig['sourceNsRegex'] + ')$'
+
+    nsPatterns = []
+    for thisNs in appConfig['sourceNsList']:
+        thisDb, thisColl = thisNs.split('.',1)
+        if (thisColl == '*'):
+            # whole database, system collections and $cmd entries are never replicated
+            nsPatterns.append(re.escape(thisDb) + r'\.(?!system\.)[^$]+')
+        else:
+            nsPatterns.append(re.escape(thisNs))
+    return '^(?:' + '|'.join(nsPatterns) + ')$'
+
+
+def get_namespace_filter(appConfig):
+    # value for the "ns" field of an oplog query
+    if (appConfig['sourceNsRegex'] is None) and (len(appConfig['sourceNsList']) == 1) and (not appConfig['sourceNsList'][0].endswith('.*')):
+        # a single collection is an equality match
+        return appConfig['sourceNsList'][0]
+    return {'$regex': get_namespace_pattern(appConfig)}
+
+
+def get_target_ns(appConfig, sourceNs):
+    # where changes to sourceNs are applied, --namespace-map first then --target-database then --target-namespace
+    if sourceNs in appConfig['namespaceMap']:
+        return appConfig['namespaceMap'][sourceNs]
+    if (appConfig['targetDatabase'] is not None):
+        return appConfig['targetDatabase'] + '.' + sourceNs.split('.',1)[1]
+    if (appConfig['targetNs'] is not None):
+        return appConfig['targetNs']
+    return sourceNs
+
+
+def get_change_stream_source(appConfig, sourceConnection):
+    # narrowest scope able to watch every selected namespace, a collection, a database, or the whole deployment
+    if (appConfig['sourceNsRegex'] is None):
+        sourceDbs = set(thisNs.split('.',1)[0] for thisNs in appConfig['sourceNsList'])
+        if (len(appConfig['sourceNsList']) == 1) and (not appConfig['sourceNsList'][0].endswith('.*')):
+            return sourceConnection[appConfig['sourceNsList'][0].split('.',1)[0]][appConfig['sourceNsList'][0].split('.',1)[1]]
+        elif (len(sourceDbs) == 1):
+            return sourceConnection[sourceDbs.pop()]
+    return sourceConnection
+
+
+def get_change_stream_match(appConfig):
+    # $match on the namespace of each change, a --source-namespace-regex is only checked by the workers
+    if (appConfig['sourceNsRegex'] is not None):
+        return {}
+
+    nsMatchList = []
+    for thisNs in appConfig['sourceNsList']:
+        thisDb, thisColl = thisNs.split('.',1)
+        if (thisColl == '*'):
+            nsMatchList.append({'ns.db': thisDb, 'ns.coll': {'$not': {'$regex': '^system\\.'}}})
+        else:
+            nsMatchList.append({'ns.db': thisDb, 'ns.coll': thisColl})
+
+    if (len(nsMatchList) == 1):
+        return nsMatchList[0]
+    return {'$or': nsMatchList}
+
+
+def hand_off(workQueues, workBudgets, workerNum, workItem, numBytes, positionOnly=False):
+    # every target is sent the same list for the worker, each through its own queue and byte budget
+    # a message with only the reader's position is dropped for a worker that has not taken the previous one, the next position reaches it instead
+    # otherwise a slow target would fill its queue with positions and block the reader, stalling the fast targets with it
+    for targetNum in range(len(workQueues)):
+        if positionOnly and not workBudgets[targetNum][workerNum].queue_position():
+            continue
+        if not workBudgets[targetNum][workerNum].acquire(numBytes):
+            stop_reader()
+        put_work(workQueues[targetNum][workerNum],workBudgets[targetNum][workerNum],workItem)
+
+
+def put_work(workQueue, workBudget, workItem):
+    # a full queue is waited on in steps, a worker that has exited never empties it
+    while True:
+        try:
+            workQueue.put(workItem,timeout=1)
+            return
+        except queue.Full:
+            if (workBudget.workerFailed.value == 1):
+                stop_reader()
+
+
+def stop_reader():
+    # the main process stops every other process and exits with an error
+    logIt(-1,'a worker exited with an error, stopping the reader')
+    sys.exit(1)
+
+
+def drain_workers(workQueues, workBudgets, drainQueue, numActiveWorkers):
+    # barrier before the reader changes which worker owns each _id
+    # returns once every active worker of every target has applied everything it was sent, so no _id has operations pending in two workers
+    # with several targets the reader waits here for the slowest one, a lagging target delays changing the number of threads for all of them
+    for targetNum in range(len(workQueues)):
+        for workerNum in range(numActiveWorkers):
+            put_work(workQueues[targetNum][workerNum],workBudgets[targetNum][workerNum],'DRAIN')
+    numDrained = 0
+    while (numDrained < len(workQueues) * numActiveWorkers):
+        try:
+            drainQueue.get(timeout=1)
+            numDrained += 1
+        except queue.Empty:
+            # every budget shares the flag
+            if (workBudgets[0][0].workerFailed.value == 1):
+                stop_reader()
+
+
+def oplog_reader(appConfig, workQueues, workBudgets, drainQueue, activeWorkers, txnHold):
+    # single tailing cursor on the oplog, each entry is routed to the worker that owns its _id
     if appConfig['verboseLogging']:
-        logIt(threadnum,'thread started')
+        logIt(-1,'oplog reader started')
 
-    c = pymongo.MongoClient(appConfig["sourceUri"])
+    # entries are forwarded to workers as raw BSON, the reader only decodes the top-level fields it routes on
+    c = pymongo.MongoClient(appConfig["sourceUri"],document_class=RawBSONDocument)
     oplog = c.local.oplog.rs
 
+    # every started worker is sent the position, only the active ones are routed entries
+    # workQueues and workBudgets hold one list per target, each target has the same number of workers
+    numWorkers = len(workQueues[0])
+    numActiveWorkers = activeWorkers.value
+    partitionOf = get_partitioner(appConfig,numActiveWorkers)
+
+    startTime = time.time()
+
+    allDone = False
+
+    # per-worker entries not yet handed off
+    pendingEntries = [[] for x in range(numWorkers)]
+    pendingBytes = [0 for x in range(numWorkers)]
+
+    # transactions are unpacked here, so their operations are partitioned like any other
+    txnBuffer = TransactionBuffer(appConfig,txnHold)
+    if appConfig['transactionalApply']:
+        # transactions are applied by the reader itself, to every target
+        targetConnections = [pymongo.MongoClient(thisTarget['targetUri']) for thisTarget in appConfig['targets']]
+
+    # starting timestamp
+    endTs = appConfig["startTs"]
+
+    while not allDone:
+        if appConfig['verboseLogging']:
+            logIt(-1,"Creating oplog tailing cursor for timestamp {}".format(endTs.as_datetime()))
+
+        # only inserts, updates, and deletes on the selected namespaces plus transaction entries are returned, no-ops and other commands stay on the server
+        # transaction entries are not filtered by namespace, the entry that commits a transaction may hold none of the selected namespaces
+        # each getMore waits on the server for up to --max-await-time-ms for new entries, there is no client side polling
+        # the cursor returns each server batch as a whole, so it is handed off as soon as it is routed
+        oplogQuery = {'ts': {'$gte': endTs},
+                      '$or': [{'ns':get_namespace_filter(appConfig),'op':{'$in':['i','u','d']}},
+                              {'op':'c','$or':[{'o.applyOps':{'$exists':True}},{'o.commitTransaction':{'$exists':True}},{'o.abortTransaction':{'$exists':True}}]}]}
+        cursor = oplog.find_raw_batches(oplogQuery,projection=OPLOG_PROJECTION,cursor_type=pymongo.CursorType.TAILABLE_AWAIT,oplog_replay=True).max_await_time_ms(appConfig["maxAwaitTimeMs"])
+        if (appConfig["oplogBatchSize"] > 0):
+            cursor = cursor.batch_size(appConfig["oplogBatchSize"])
+
+        while cursor.alive and not allDone:
+            # at most one server batch, none if nothing arrived within --max-await-time-ms
+            docList = []
+            for rawBatch in cursor:
+                docList = bson.decode_all(rawBatch,codec_options=CodecOptions(document_class=RawBSONDocument))
+                break
+
+            for doc in docList:
+                # check if time to exit
+                if ((time.time() - startTime) > appConfig['durationSeconds']) and (appConfig['durationSeconds'] != 0):
+                    allDone = True
+                    break
+
+                # position of everything before this entry, a transaction's operations all take the ts of its commit
+                # a hand off in the middle of one carries this position, so no worker reports the commit before every operation is applied
+                prevTs = endTs
+                endTs = doc['ts']
+
+                if (doc['op'] == 'c'):
+                    # one entry per operation once a transaction commits
+                    routeList = txnBuffer.add(doc)
+                    if appConfig['transactionalApply'] and (len(routeList) > 0):
+                        # everything before the transaction is applied first, then the whole transaction in one target transaction
+                        for workerNum in range(numWorkers):
+                            hand_off(workQueues,workBudgets,workerNum,(prevTs,pendingEntries[workerNum],pendingBytes[workerNum]),pendingBytes[workerNum],len(pendingEntries[workerNum]) == 0)
+                            pendingEntries[workerNum] = []
+                            pendingBytes[workerNum] = 0
+                        drain_workers(workQueues,workBudgets,drainQueue,numActiveWorkers)
+                        for targetNum, thisTarget in enumerate(appConfig['targets']):
+                            txnSeconds = apply_transaction(dict(appConfig,**thisTarget),targetConnections[targetNum],routeList)
+                            if appConfig['verboseLogging']:
+                                logIt(-1,"applied transaction of {:,d} operations at timestamp {} to target {} in {:.3f} secs".format(len(routeList),endTs.as_datetime(),targetNum,txnSeconds))
+                        routeList = []
+                else:
+                    routeList = [doc]
+
+                for routeDoc in routeList:
+                    if (routeDoc['op'] in ['i','d']):
+                        docId = get_document_id(routeDoc['o'])
+                    else:
+                        docId = routeDoc['o2']['_id']
+
+                    workerNum = partitionOf(docId)
+
+                    pendingEntries[workerNum].append(routeDoc.raw)
+                    pendingBytes[workerNum] += len(routeDoc.raw)
+                    if (len(pendingEntries[workerNum]) >= appConfig["maxOperationsPerBatch"]):
+                        hand_off(workQueues,workBudgets,workerNum,(prevTs,pendingEntries[workerNum],pendingBytes[workerNum]),pendingBytes[workerNum])
+                        pendingEntries[workerNum] = []
+                        pendingBytes[workerNum] = 0
+
+            # the server batch is routed or the cursor is idle, hand off everything collected so far
+            # every worker gets the current timestamp so idle workers can still advance their checkpoint
+            for workerNum in range(numWorkers):
+                hand_off(workQueues,workBudgets,workerNum,(endTs,pendingEntries[workerNum],pendingBytes[workerNum]),pendingBytes[workerNum],len(pendingEntries[workerNum]) == 0)
+                pendingEntries[workerNum] = []
+                pendingBytes[workerNum] = 0
+
+            # release the transactions applied since the last hand off
+            txnHold.publish()
+
+            if (activeWorkers.value != numActiveWorkers):
+                # everything up to endTs has been handed off, switch once it is applied
+                drain_workers(workQueues,workBudgets,drainQueue,numActiveWorkers)
+                logIt(-1,"changing from {} to {} threads at timestamp {}".format(numActiveWorkers,activeWorkers.value,endTs.as_datetime()))
+                numActiveWorkers = activeWorkers.value
+                partitionOf = get_partitioner(appConfig,numActiveWorkers)
+
+        if (not cursor.alive) and (not allDone):
+            # the cursor was closed by the server, pause before creating a new one
+            time.sleep(1)
+
+    # tell every worker there is nothing more to come
+    for workerNum in range(numWorkers):
+        hand_off(workQueues,workBudgets,workerNum,(endTs,pendingEntries[workerNum],pendingBytes[workerNum]),pendingBytes[workerNum])
+        hand_off(workQueues,workBudgets,workerNum,None,0)
+
+    if appConfig['transactionalApply']:
+        for targetConnection in targetConnections:
+            targetConnection.close()
+    c.close()
+
+
+def oplog_processor(threadnum, appConfig, workQ, workBudget, drainQueue, workerMetrics):
+    if appConfig['verboseLogging']:
+        logIt(threadnum,'thread started')
+
     destConnection = pymongo.MongoClient(appConfig["targetUri"])
-    destDatabase = destConnection[appConfig["targetNs"].split('.',1)[0]]
-    destCollection = destDatabase[appConfig["targetNs"].split('.',1)[1]]
 
     '''
     i  = insert
@@ -42,155 +1025,263 @@ def oplog_processor(threadnum, appConfig, perfQ):
     allDone = False
     threadOplogEntries = 0
 
-    bulkOpList = []
-    
-    # list with replace, not insert, in case document already exists (replaying old oplog)
-    bulkOpListReplace = []
+    # operations as (type, _id, filter, document or update) per source namespace, turned into bulk_write requests when applied
+    bulkOps = {}
     numCurrentBulkOps = 0
+    numCurrentBulkBytes = 0
+
+    # source time of each operation in the current batch, for the end-to-end latency histogram
+    batchSourceSeconds = []
     
     numTotalBatches = 0
         
     printedFirstTs = False
     myCollectionOps = 0
 
-    # starting timestamp
+    batchSizer = BatchSizer(appConfig,appConfig["maxOperationsPerBatch"])
+
+    # position up to which everything routed to this thread has been received
     endTs = appConfig["startTs"]
 
     while not allDone:
-        if appConfig['verboseLogging']:
-            logIt(threadnum,"Creating oplog tailing cursor for timestamp {}".format(endTs.as_datetime()))
+        if (numCurrentBulkOps > 0):
+            # wake up when the current batch is due even if nothing else arrives
+            getTimeout = max(0.0,lastBatch + appConfig["maxSecondsBetweenBatches"] - time.time())
+        else:
+            getTimeout = 1
+        try:
+            message = workQ.get(timeout=getTimeout)
+        except queue.Empty:
+            # nothing routed to this thread, check if the current batch is due
+            message = (endTs,[],0)
+
+        if message is None:
+            # reader has finished
+            allDone = True
+            message = (endTs,[],0)
+
+        drainRequested = (message == 'DRAIN')
+        if drainRequested:
+            # the reader is changing the number of threads, apply everything received so far
+            message = (endTs,[],0)
+
+        readerTs, entryList, messageBytes = message
+
+        # the entries are now held by this thread's batch, which is bounded by the batch size
+        workBudget.release(messageBytes)
+
+        for entryNum, rawEntry in enumerate(entryList):
+            if appConfig['rawPassthrough']:
+                # documents stay as the BSON read from the oplog and are written without re-encoding them
+                doc = RawBSONDocument(rawEntry)
+            else:
+                doc = bson.decode(rawEntry)
+
+            endTs = doc['ts']
+            threadOplogEntries += 1
+            numCurrentBulkBytes += len(rawEntry)
+            batchSourceSeconds.append(get_source_seconds(doc.get('wall'),doc['ts']))
+
+            if (not printedFirstTs):
+                if appConfig['verboseLogging']:
+                    logIt(threadnum,'first timestamp = {} aka {}'.format(doc['ts'],doc['ts'].as_datetime()))
+                printedFirstTs = True
+
+            if (doc['op'] in ['i','u','d']):
+                # insert, update, or delete, operations from transactions were unpacked by the reader
+                entryBulkOps = get_oplog_bulk_ops(doc)
+                if (entryBulkOps is None):
+                    logIt(threadnum,"oplog update at timestamp {} cannot be applied, a changed field name contains a dot or starts with $, use --use-change-stream".format(doc['ts'].as_datetime()))
+                    sys.exit(1)
+                myCollectionOps += 1
+                bulkOps.setdefault(doc['ns'],[]).extend(entryBulkOps)
+                numCurrentBulkOps += len(entryBulkOps)
+
+            else:
+                print(doc)
+                sys.exit(1)
+
+            if batchSizer.isFull(numCurrentBulkOps,numCurrentBulkBytes):
+                batchSeconds, batchFailed, numAppliedOps = apply_namespace_bulk_ops(appConfig,destConnection,bulkOps)
+                batchSizer.record(numCurrentBulkOps,numCurrentBulkBytes,batchSeconds,batchFailed)
+                publish_batch(workerMetrics,numCurrentBulkOps,numAppliedOps,numCurrentBulkBytes,batchSeconds,batchSizer.batchOps,batchSourceSeconds)
+                # the operations of a transaction share its commit ts, the position is only published once every entry at it is applied
+                if (entryNum + 1 < len(entryList)):
+                    positionComplete = (RawBSONDocument(entryList[entryNum + 1])['ts'] != endTs)
+                else:
+                    positionComplete = (endTs <= readerTs)
+                if positionComplete:
+                    publish_position(workerMetrics,endTs)
+                bulkOps = {}
+                numCurrentBulkOps = 0
+                numCurrentBulkBytes = 0
+                batchSourceSeconds = []
+                numTotalBatches += 1
+                lastBatch = time.time()
 
-        cursor = oplog.find({'ts': {'$gte': endTs},'ns':appConfig["sourceNs"]},cursor_type=pymongo.CursorType.TAILABLE_AWAIT,oplog_replay=True)
+        # the whole message has been received, nothing else at or before the reader's position belongs to this thread
+        endTs = readerTs
 
-        while cursor.alive and not allDone:
-            for doc in cursor:
-                # check if time to exit
-                if ((time.time() - startTime) > appConfig['durationSeconds']) and (appConfig['durationSeconds'] != 0):
-                    allDone = True
-                    break
+        if ((time.time() >= (lastBatch + appConfig["maxSecondsBetweenBatches"])) or allDone or drainRequested) and (numCurrentBulkOps > 0):
+            batchSeconds, batchFailed, numAppliedOps = apply_namespace_bulk_ops(appConfig,destConnection,bulkOps)
+            batchSizer.record(numCurrentBulkOps,numCurrentBulkBytes,batchSeconds,batchFailed)
+            publish_batch(workerMetrics,numCurrentBulkOps,numAppliedOps,numCurrentBulkBytes,batchSeconds,batchSizer.batchOps,batchSourceSeconds)
+            bulkOps = {}
+            numCurrentBulkOps = 0
+            numCurrentBulkBytes = 0
+            batchSourceSeconds = []
+            numTotalBatches += 1
+            lastBatch = time.time()
 
-                endTs = doc['ts']
+        if (numCurrentBulkOps == 0):
+            # nothing waiting to be applied, the checkpoint can move up to the reader's position
+            publish_position(workerMetrics,endTs)
 
-                # NOTE: Python's non-deterministic hash() cannot be used as it is seeded at startup, since this code is multiprocessing we need all hash calls to be the same between processes
-                #   hash(str(doc['o']['_id']))
-                if (((doc['op'] in ['i','d']) and (doc['ns'] == appConfig["sourceNs"]) and ((int(hashlib.sha512(str(doc['o']['_id']).encode('utf-8')).hexdigest(), 16) % appConfig["numProcessingThreads"]) == threadnum)) or
-                    ((doc['op'] in ['u']) and (doc['ns'] == appConfig["sourceNs"]) and ((int(hashlib.sha512(str(doc['o2']['_id']).encode('utf-8')).hexdigest(), 16) % appConfig["numProcessingThreads"]) == threadnum))):
-                    # this is for my thread
-
-                    threadOplogEntries += 1
-
-                    if (not printedFirstTs) and (doc['op'] in ['i','u','d']) and (doc['ns'] == appConfig["sourceNs"]):
-                        if appConfig['verboseLogging']:
-                            logIt(threadnum,'first timestamp = {} aka {}'.format(doc['ts'],doc['ts'].as_datetime()))
-                        printedFirstTs = True
-
-                    if (doc['op'] == 'i'):
-                        # insert
-                        if (doc['ns'] == appConfig["sourceNs"]):
-                            myCollectionOps += 1
-                            bulkOpList.append(pymongo.InsertOne(doc['o']))
-                            # if playing old oplog, need to change inserts to be replaces (the inserts will fail due to _id uniqueness)
-                            bulkOpListReplace.append(pymongo.ReplaceOne({'_id':doc['o']['_id']},doc['o'],upsert=True))
-                            numCurrentBulkOps += 1
-                        else:
-                            pass
-
-                    elif (doc['op'] == 'u'):
-                        # update
-                        if (doc['ns'] == appConfig["sourceNs"]):
-                            myCollectionOps += 1
-                            # field "$v" is not present in MongoDB 3.4
-                            doc['o'].pop('$v',None)
-                            bulkOpList.append(pymongo.UpdateOne(doc['o2'],doc['o'],upsert=False))
-                            # if playing old oplog, need to change inserts to be replaces (the inserts will fail due to _id uniqueness)
-                            bulkOpListReplace.append(pymongo.UpdateOne(doc['o2'],doc['o'],upsert=False))
-                            numCurrentBulkOps += 1
-                        else:
-                            pass
-
-                    elif (doc['op'] == 'd'):
-                        # delete
-                        if (doc['ns'] == appConfig["sourceNs"]):
-                            myCollectionOps += 1
-                            bulkOpList.append(pymongo.DeleteOne(doc['o']))
-                            # if playing old oplog, need to change inserts to be replaces (the inserts will fail due to _id uniqueness)
-                            bulkOpListReplace.append(pymongo.DeleteOne(doc['o']))
-                            numCurrentBulkOps += 1
-                        else:
-                            pass
-
-                    elif (doc['op'] == 'c'):
-                        # command
-                        pass
-
-                    elif (doc['op'] == 'n'):
-                        # no-op
-                        pass
+        if drainRequested:
+            drainQueue.put(threadnum)
 
-                    else:
-                        print(doc)
-                        sys.exit(1)
-
-                if ((numCurrentBulkOps >= appConfig["maxOperationsPerBatch"]) or (time.time() >= (lastBatch + appConfig["maxSecondsBetweenBatches"]))) and (numCurrentBulkOps > 0):
-                    if not appConfig['dryRun']:
-                        try:
-                            result = destCollection.bulk_write(bulkOpList,ordered=True)
-                        except:
-                            # replace inserts as replaces
-                            result = destCollection.bulk_write(bulkOpListReplace,ordered=True)
-                    perfQ.put({"name":"batchCompleted","operations":numCurrentBulkOps,"endts":endTs,"processNum":threadnum})
-                    bulkOpList = []
-                    bulkOpListReplace = []
-                    numCurrentBulkOps = 0
-                    numTotalBatches += 1
-                    lastBatch = time.time()
-
-            if ((numCurrentBulkOps >= appConfig["maxOperationsPerBatch"]) or (time.time() >= (lastBatch + appConfig["maxSecondsBetweenBatches"]))) and (numCurrentBulkOps > 0):
-                if not appConfig['dryRun']:
-                    try:
-                        result = destCollection.bulk_write(bulkOpList,ordered=True)
-                    except:
-                        # replace inserts as replaces
-                        result = destCollection.bulk_write(bulkOpListReplace,ordered=True)
-                perfQ.put({"name":"batchCompleted","operations":numCurrentBulkOps,"endts":endTs,"processNum":threadnum})
-                bulkOpList = []
-                bulkOpListReplace = []
-                numCurrentBulkOps = 0
-                numTotalBatches += 1
-                lastBatch = time.time()
+    destConnection.close()
 
-            # nothing arrived in the oplog for 1 second, pause before trying again
-            time.sleep(1)
+    publish_completed(workerMetrics)
 
-    if (numCurrentBulkOps > 0):
-        if not appConfig['dryRun']:
-            try:
-                result = destCollection.bulk_write(bulkOpList,ordered=True)
-            except:
-                # replace inserts as replaces
-                result = destCollection.bulk_write(bulkOpListReplace,ordered=True)
-        perfQ.put({"name":"batchCompleted","operations":numCurrentBulkOps,"endts":endTs,"processNum":threadnum})
-        bulkOpList = []
-        bulkOpListReplace = []
-        numCurrentBulkOps = 0
-        numTotalBatches += 1
 
-    c.close()
+def change_stream_batch_done(stream):
+    # True once every change of the last server batch has been returned, the next try_next runs a getMore
+    # the driver has no public call for this, its cursor is checked directly, None if this driver version does not have it
+    hasNext = getattr(getattr(stream,'_cursor',None),'_has_next',None)
+    if (hasNext is None):
+        return None
+    return not hasNext()
+
+
+def change_stream_reader(appConfig, workQueues, workBudgets, drainQueue, activeWorkers):
+    # single change stream, each change is routed to the worker that owns its _id
+    # the server performs the updateLookup for a change once, no matter how many workers there are
+    if appConfig['verboseLogging']:
+        logIt(-1,'change stream reader started')
+
+    # changes are forwarded to workers as raw BSON, the reader only decodes the fields it routes on
+    sourceConnection = pymongo.MongoClient(appConfig["sourceUri"],document_class=RawBSONDocument)
+    sourceWatch = get_change_stream_source(appConfig,sourceConnection)
 
-    perfQ.put({"name":"processCompleted","processNum":threadnum})
+    # every started worker is sent the position, only the active ones are routed changes
+    # workQueues and workBudgets hold one list per target, each target has the same number of workers
+    numWorkers = len(workQueues[0])
+    numActiveWorkers = activeWorkers.value
+    partitionOf = get_partitioner(appConfig,numActiveWorkers)
 
+    # the watch may be database or deployment wide, every change is still checked against the selected namespaces
+    nsPattern = re.compile(get_namespace_pattern(appConfig))
+
+    startTime = time.time()
+
+    # only used when the driver does not say where its batches end, everything is then handed off this often
+    handOffSeconds = min(1.0,appConfig["maxSecondsBetweenBatches"])
+    lastHandOff = time.time()
+
+    allDone = False
+
+    # per-worker changes not yet handed off
+    pendingChanges = [[] for x in range(numWorkers)]
+    pendingBytes = [0 for x in range(numWorkers)]
+
+    # starting timestamp
+    endTs = appConfig["startTs"]
+    resumeToken = None
+
+    changeMatch = {'operationType': {'$in': ['insert','update','replace','delete']}}
+    changeMatch.update(get_change_stream_match(appConfig))
+
+    changePipeline = [{'$match': changeMatch}]
+    if appConfig['deltaUpdates']:
+        # updates are applied from their updateDescription, the source does not look up the whole document
+        fullDocument = 'default'
+    else:
+        fullDocument = 'updateLookup'
+        changePipeline.append({'$project':{'updateDescription':0}})
+
+    # expanded events add disambiguatedPaths to each updateDescription (6.1+), other servers reject the option
+    # only insert, update, replace, and delete pass the $match, the extra event types never reach the reader
+    # the option is only passed when used, drivers before PyMongo 4.3 do not accept it
+    watchOptions = {}
+    if appConfig['deltaUpdates'] and (list(sourceConnection.server_info()['versionArray'][:2]) >= [6,1]):
+        watchOptions['show_expanded_events'] = True
+
+    if (appConfig["startTs"] == "RESUME_TOKEN"):
+        stream = sourceWatch.watch(resume_after={'_data': appConfig["startPosition"]}, full_document=fullDocument, pipeline=changePipeline, max_await_time_ms=appConfig["maxAwaitTimeMs"], **watchOptions)
+    else:
+        stream = sourceWatch.watch(start_at_operation_time=endTs, full_document=fullDocument, pipeline=changePipeline, max_await_time_ms=appConfig["maxAwaitTimeMs"], **watchOptions)
 
-def change_stream_processor(threadnum, appConfig, perfQ):
     if appConfig['verboseLogging']:
-        logIt(threadnum,'thread started')
+        if (appConfig["startTs"] == "RESUME_TOKEN"):
+            logIt(-1,"Creating change stream cursor for resume token {}".format(appConfig["startPosition"]))
+        else:
+            logIt(-1,"Creating change stream cursor for timestamp {}".format(endTs.as_datetime()))
 
-    sourceConnection = pymongo.MongoClient(appConfig["sourceUri"])
-    sourceDb = sourceConnection[appConfig["sourceNs"].split('.',1)[0]]
-    sourceColl = sourceDb[appConfig["sourceNs"].split('.',1)[1]]
+    while not allDone:
+        # returns None when nothing arrived within --max-await-time-ms
+        change = stream.try_next()
+
+        # check if time to exit
+        if ((time.time() - startTime) > appConfig['durationSeconds']) and (appConfig['durationSeconds'] != 0):
+            allDone = True
+            break
+
+        if change is not None:
+            endTs = change['clusterTime']
+            resumeToken = change['_id']['_data']
+            thisNs = change['ns']['db']+'.'+change['ns']['coll']
+
+            if (nsPattern.match(thisNs) is not None):
+                workerNum = partitionOf(change['documentKey']['_id'])
+
+                pendingChanges[workerNum].append(change.raw)
+                pendingBytes[workerNum] += len(change.raw)
+                if (len(pendingChanges[workerNum]) >= appConfig["maxOperationsPerBatch"]):
+                    hand_off(workQueues,workBudgets,workerNum,(endTs,resumeToken,pendingChanges[workerNum],pendingBytes[workerNum]),pendingBytes[workerNum])
+                    pendingChanges[workerNum] = []
+                    pendingBytes[workerNum] = 0
+
+        # hand off everything when the stream is idle or every change of the last server batch has been routed
+        # every worker gets the current position so idle workers can still advance their checkpoint
+        if (change is None):
+            handOffDue = True
+        else:
+            handOffDue = change_stream_batch_done(stream)
+            if (handOffDue is None):
+                handOffDue = (time.time() >= (lastHandOff + handOffSeconds))
+
+        if handOffDue:
+            for workerNum in range(numWorkers):
+                hand_off(workQueues,workBudgets,workerNum,(endTs,resumeToken,pendingChanges[workerNum],pendingBytes[workerNum]),pendingBytes[workerNum],len(pendingChanges[workerNum]) == 0)
+                pendingChanges[workerNum] = []
+                pendingBytes[workerNum] = 0
+            lastHandOff = time.time()
+
+            if (activeWorkers.value != numActiveWorkers) and (endTs != "RESUME_TOKEN"):
+                # everything up to endTs has been handed off, switch once it is applied
+                drain_workers(workQueues,workBudgets,drainQueue,numActiveWorkers)
+                logIt(-1,"changing from {} to {} threads at timestamp {}".format(numActiveWorkers,activeWorkers.value,endTs.as_datetime()))
+                numActiveWorkers = activeWorkers.value
+                partitionOf = get_partitioner(appConfig,numActiveWorkers)
+
+    # tell every worker there is nothing more to come
+    for workerNum in range(numWorkers):
+        hand_off(workQueues,workBudgets,workerNum,(endTs,resumeToken,pendingChanges[workerNum],pendingBytes[workerNum]),pendingBytes[workerNum])
+        hand_off(workQueues,workBudgets,workerNum,None,0)
+
+    stream.close()
+    sourceConnection.close()
+
+
+def change_stream_processor(threadnum, appConfig, workQ, workBudget, drainQueue, workerMetrics):
+    if appConfig['verboseLogging']:
+        logIt(threadnum,'thread started')
 
     destConnection = pymongo.MongoClient(appConfig["targetUri"])
-    destDatabase = destConnection[appConfig["targetNs"].split('.',1)[0]]
-    destCollection = destDatabase[appConfig["targetNs"].split('.',1)[1]]
+
+    # only connected when a delta update has to fall back to copying the current document
+    sourceConnection = None
 
     startTime = time.time()
     lastFeedback = time.time()
@@ -199,147 +1290,368 @@ def change_stream_processor(threadnum, appConfig, perfQ):
     allDone = False
     threadOplogEntries = 0
 
-    bulkOpList = []
-
-    # list with replace, not insert, in case document already exists (replaying old oplog)
-    bulkOpListReplace = []
+    # operations as (type, _id, filter, document or update) per source namespace, turned into bulk_write requests when applied
+    bulkOps = {}
     numCurrentBulkOps = 0
 
+    numCurrentBulkBytes = 0
+
+    # source time of each operation in the current batch, for the end-to-end latency histogram
+    batchSourceSeconds = []
+
     numTotalBatches = 0
 
     printedFirstTs = False
     myCollectionOps = 0
 
-    # starting timestamp
-    endTs = appConfig["startTs"]
+    batchSizer = BatchSizer(appConfig,appConfig["maxOperationsPerBatch"])
 
-    if (appConfig["startTs"] == "RESUME_TOKEN"):
-        stream = sourceColl.watch(resume_after={'_data': appConfig["startPosition"]}, full_document='updateLookup', pipeline=[{'$match': {'operationType': {'$in': ['insert','update','replace','delete']}}},{'$project':{'updateDescription':0}}])
-    else:
-        stream = sourceColl.watch(start_at_operation_time=endTs, full_document='updateLookup', pipeline=[{'$match': {'operationType': {'$in': ['insert','update','replace','delete']}}},{'$project':{'updateDescription':0}}])
+    # position up to which everything for this thread has been received
+    endTs = appConfig["startTs"]
+    resumeToken = None
 
-    if appConfig['verboseLogging']:
-        if (appConfig["startTs"] == "RESUME_TOKEN"):
-            logIt(threadnum,"Creating change stream cursor for resume token {}".format(appConfig["startPosition"]))
+    while not allDone:
+        if (numCurrentBulkOps > 0):
+            # wake up when the current batch is due even if nothing else arrives
+            getTimeout = max(0.0,lastBatch + appConfig["maxSecondsBetweenBatches"] - time.time())
         else:
-            logIt(threadnum,"Creating change stream cursor for timestamp {}".format(endTs.as_datetime()))
+            getTimeout = 1
+        try:
+            message = workQ.get(timeout=getTimeout)
+        except queue.Empty:
+            # nothing received, check if the current batch is due
+            message = (endTs,resumeToken,[],0)
+
+        if message is None:
+            # reader has finished
+            allDone = True
+            message = (endTs,resumeToken,[],0)
 
-    while not allDone:
-        for change in stream:
-            # check if time to exit
-            if ((time.time() - startTime) > appConfig['durationSeconds']) and (appConfig['durationSeconds'] != 0):
-                allDone = True
-                break
+        drainRequested = (message == 'DRAIN')
+        if drainRequested:
+            # the reader is changing the number of threads, apply everything received so far
+            message = (endTs,resumeToken,[],0)
+
+        readerTs, readerResumeToken, changeList, messageBytes = message
+
+        # the changes are now held by this thread's batch, which is bounded by the batch size
+        workBudget.release(messageBytes)
+
+        for rawChange in changeList:
+            change = RawBSONDocument(rawChange)
 
             endTs = change['clusterTime']
             resumeToken = change['_id']['_data']
             thisNs = change['ns']['db']+'.'+change['ns']['coll']
             thisOp = change['operationType']
 
-            # NOTE: Python's non-deterministic hash() cannot be used as it is seeded at startup, since this code is multiprocessing we need all hash calls to be the same between processes
-            #   hash(str(doc['o']['_id']))
-            #if ((thisOp in ['insert','update','replace','delete']) and
-            #     (thisNs == appConfig["sourceNs"]) and
-            if ((int(hashlib.sha512(str(change['documentKey']).encode('utf-8')).hexdigest(), 16) % appConfig["numProcessingThreads"]) == threadnum):
-                # this is for my thread
+            threadOplogEntries += 1
+            numCurrentBulkBytes += len(rawChange)
+            batchSourceSeconds.append(get_source_seconds(change.get('wallTime'),change['clusterTime']))
+
+            if (not printedFirstTs):
+                if appConfig['verboseLogging']:
+                    logIt(threadnum,'first timestamp = {} aka {}'.format(change['clusterTime'],change['clusterTime'].as_datetime()))
+                printedFirstTs = True
+
+            if (thisOp == 'insert'):
+                # insert
+                myCollectionOps += 1
+                bulkOps.setdefault(thisNs,[]).append(('i',change['documentKey']['_id'],change['documentKey'],change['fullDocument']))
+                numCurrentBulkOps += 1
+
+            elif (thisOp == 'update') and appConfig['deltaUpdates']:
+                # update, only the changed fields
+                updateDoc = get_delta_update(change['updateDescription'])
+                if (updateDoc is None):
+                    # replace with the current source document, as updateLookup would have
+                    if (sourceConnection is None):
+                        sourceConnection = pymongo.MongoClient(appConfig["sourceUri"],document_class=RawBSONDocument)
+                    currentDoc = sourceConnection[change['ns']['db']][change['ns']['coll']].find_one(change['documentKey'])
+                    if (currentDoc is not None):
+                        myCollectionOps += 1
+                        bulkOps.setdefault(thisNs,[]).append(('r',change['documentKey']['_id'],change['documentKey'],currentDoc))
+                        numCurrentBulkOps += 1
+                elif (len(updateDoc) > 0):
+                    myCollectionOps += 1
+                    bulkOps.setdefault(thisNs,[]).append(('u',change['documentKey']['_id'],change['documentKey'],updateDoc))
+                    numCurrentBulkOps += 1
+
+            elif (thisOp in ['update','replace']):
+                # update/replace
+                if (change['fullDocument'] is not None):
+                    myCollectionOps += 1
+                    bulkOps.setdefault(thisNs,[]).append(('r',change['documentKey']['_id'],change['documentKey'],change['fullDocument']))
+                    numCurrentBulkOps += 1
+
+            elif (thisOp == 'delete'):
+                # delete
+                myCollectionOps += 1
+                bulkOps.setdefault(thisNs,[]).append(('d',change['documentKey']['_id'],{'_id':change['documentKey']['_id']},None))
+                numCurrentBulkOps += 1
+
+            elif (thisOp in ['drop','rename','dropDatabase','invalidate']):
+                # operations we do not track
+                pass
+
+            else:
+                print(change)
+                sys.exit(1)
+
+            if batchSizer.isFull(numCurrentBulkOps,numCurrentBulkBytes):
+                batchSeconds, batchFailed, numAppliedOps = apply_namespace_bulk_ops(appConfig,destConnection,bulkOps)
+                batchSizer.record(numCurrentBulkOps,numCurrentBulkBytes,batchSeconds,batchFailed)
+                publish_batch(workerMetrics,numCurrentBulkOps,numAppliedOps,numCurrentBulkBytes,batchSeconds,batchSizer.batchOps,batchSourceSeconds)
+                publish_position(workerMetrics,endTs,resumeToken)
+                bulkOps = {}
+                numCurrentBulkOps = 0
+                numCurrentBulkBytes = 0
+                batchSourceSeconds = []
+                numTotalBatches += 1
+                lastBatch = time.time()
 
-                threadOplogEntries += 1
+        # the whole message has been received, nothing else at or before the reader's position belongs to this thread
+        endTs = readerTs
+        resumeToken = readerResumeToken
+
+        if ((time.time() >= (lastBatch + appConfig["maxSecondsBetweenBatches"])) or allDone or drainRequested) and (numCurrentBulkOps > 0):
+            batchSeconds, batchFailed, numAppliedOps = apply_namespace_bulk_ops(appConfig,destConnection,bulkOps)
+            batchSizer.record(numCurrentBulkOps,numCurrentBulkBytes,batchSeconds,batchFailed)
+            publish_batch(workerMetrics,numCurrentBulkOps,numAppliedOps,numCurrentBulkBytes,batchSeconds,batchSizer.batchOps,batchSourceSeconds)
+            bulkOps = {}
+            numCurrentBulkOps = 0
+            numCurrentBulkBytes = 0
+            batchSourceSeconds = []
+            numTotalBatches += 1
+            lastBatch = time.time()
+
+        if (numCurrentBulkOps == 0) and (endTs != "RESUME_TOKEN"):
+            # nothing waiting to be applied, the checkpoint can move up to the reader's position
+            publish_position(workerMetrics,endTs,resumeToken)
+
+        if drainRequested:
+            drainQueue.put(threadnum)
+
+    if (sourceConnection is not None):
+        sourceConnection.close()
+    destConnection.close()
+
+    publish_completed(workerMetrics)
+
+
+def get_segment_files(segmentDir, cdcSource):
+    # complete segment files as (segment number, path) in the order they were captured, temporary files are skipped
+    segmentPattern = re.compile('^' + re.escape(cdcSource) + r'-(\d+)\.bson\.gz$')
+    segmentList = []
+    for fileName in os.listdir(segmentDir):
+        fileMatch = segmentPattern.match(fileName)
+        if fileMatch is not None:
+            segmentList.append((int(fileMatch.group(1)),os.path.join(segmentDir,fileName)))
+    segmentList.sort()
+    return segmentList
+
+
+def capture_writer(threadnum, appConfig, workQ, workBudget, drainQueue, workerMetrics):
+    # writes every entry the reader routes to it to gzip compressed segment files of concatenated raw BSON, applied later with --replay-dir
+    # a segment is written under a temporary name and renamed once it is complete and synced, the checkpoint only moves past complete segments
+    if appConfig['verboseLogging']:
+        logIt(threadnum,'capture writer started')
 
-                if (not printedFirstTs) and (thisOp in ['insert','update','replace','delete']) and (thisNs == appConfig["sourceNs"]):
-                    if appConfig['verboseLogging']:
-                        logIt(threadnum,'first timestamp = {} aka {}'.format(change['clusterTime'],change['clusterTime'].as_datetime()))
-                    printedFirstTs = True
+    os.makedirs(appConfig['captureDir'],exist_ok=True)
 
-                if (thisOp == 'insert'):
-                    # insert
-                    if (thisNs == appConfig["sourceNs"]):
-                        myCollectionOps += 1
-                        bulkOpList.append(pymongo.InsertOne(change['fullDocument']))
-                        # if playing old oplog, need to change inserts to be replaces (the inserts will fail due to _id uniqueness)
-                        #bulkOpListReplace.append(pymongo.ReplaceOne({'_id':change['documentKey']},change['fullDocument'],upsert=True))
-                        bulkOpListReplace.append(pymongo.ReplaceOne(change['documentKey'],change['fullDocument'],upsert=True))
-                        numCurrentBulkOps += 1
-                    else:
-                        pass
-
-                elif (thisOp in ['update','replace']):
-                    # update/replace
-                    if (change['fullDocument'] is not None):
-                        if (thisNs == appConfig["sourceNs"]):
-                            myCollectionOps += 1
-                            #bulkOpList.append(pymongo.ReplaceOne({'_id':change['documentKey']},change['fullDocument'],upsert=True))
-                            bulkOpList.append(pymongo.ReplaceOne(change['documentKey'],change['fullDocument'],upsert=True))
-                            # if playing old oplog, need to change inserts to be replaces (the inserts will fail due to _id uniqueness)
-                            #bulkOpListReplace.append(pymongo.ReplaceOne({'_id':change['documentKey']},change['fullDocument'],upsert=True))
-                            bulkOpListReplace.append(pymongo.ReplaceOne(change['documentKey'],change['fullDocument'],upsert=True))
-                            numCurrentBulkOps += 1
-                        else:
-                            pass
-
-                elif (thisOp == 'delete'):
-                    # delete
-                    if (thisNs == appConfig["sourceNs"]):
-                        myCollectionOps += 1
-                        bulkOpList.append(pymongo.DeleteOne({'_id':change['documentKey']['_id']}))
-                        # if playing old oplog, need to change inserts to be replaces (the inserts will fail due to _id uniqueness)
-                        bulkOpListReplace.append(pymongo.DeleteOne({'_id':change['documentKey']['_id']}))
-                        numCurrentBulkOps += 1
-                    else:
-                        pass
+    # a restarted capture continues the numbering, replay reads the segments in order
+    segmentNum = max([thisNum for thisNum, thisPath in get_segment_files(appConfig['captureDir'],appConfig['cdcSource'])],default=0) + 1
 
-                elif (thisOp in ['drop','rename','dropDatabase','invalidate']):
-                    # operations we do not track
-                    pass
+    segmentFile = None
+    segmentBytes = 0
+    segmentStartTime = time.time()
 
-                else:
-                    print(change)
-                    sys.exit(1)
+    allDone = False
 
-            if ((numCurrentBulkOps >= appConfig["maxOperationsPerBatch"]) or (time.time() >= (lastBatch + appConfig["maxSecondsBetweenBatches"]))) and (numCurrentBulkOps > 0):
-                if not appConfig['dryRun']:
-                    try:
-                        result = destCollection.bulk_write(bulkOpList,ordered=True)
-                    except:
-                        # replace inserts as replaces
-                        result = destCollection.bulk_write(bulkOpListReplace,ordered=True)
-                perfQ.put({"name":"batchCompleted","operations":numCurrentBulkOps,"endts":endTs,"processNum":threadnum,"resumeToken":resumeToken})
-                bulkOpList = []
-                bulkOpListReplace = []
-                numCurrentBulkOps = 0
-                numTotalBatches += 1
-                lastBatch = time.time()
+    # position up to which everything has been received
+    endTs = appConfig["startTs"]
+    resumeToken = None
 
-            # nothing arrived in the oplog for 1 second, pause before trying again
-            #time.sleep(1)
+    while not allDone:
+        try:
+            message = workQ.get(timeout=1)
+        except queue.Empty:
+            message = (endTs,resumeToken,[],0)
 
-    if (numCurrentBulkOps > 0):
-        if not appConfig['dryRun']:
-            try:
-                result = destCollection.bulk_write(bulkOpList,ordered=True)
-            except:
-                # replace inserts as replaces
-                result = destCollection.bulk_write(bulkOpListReplace,ordered=True)
-        perfQ.put({"name":"batchCompleted","operations":numCurrentBulkOps,"endts":endTs,"processNum":threadnum,"resumeToken":resumeToken})
-        bulkOpList = []
-        bulkOpListReplace = []
-        numCurrentBulkOps = 0
-        numTotalBatches += 1
+        if message is None:
+            # reader has finished
+            allDone = True
+            message = (endTs,resumeToken,[],0)
 
-    c.close()
+        drainRequested = (message == 'DRAIN')
+        if drainRequested:
+            message = (endTs,resumeToken,[],0)
+
+        # oplog messages have no resume token
+        if (len(message) == 3):
+            readerTs, entryList, messageBytes = message
+            readerResumeToken = None
+        else:
+            readerTs, readerResumeToken, entryList, messageBytes = message
+
+        workBudget.release(messageBytes)
+
+        if (len(entryList) > 0):
+            writeStartTime = time.time()
+            if segmentFile is None:
+                segmentFileName = os.path.join(appConfig['captureDir'],'{}-{:08d}.bson.gz'.format(appConfig['cdcSource'],segmentNum))
+                rawSegmentFile = open(segmentFileName + '.tmp','wb')
+                # level 6 compresses BSON nearly as well as 9 at a fraction of the CPU
+                segmentFile = gzip.GzipFile(fileobj=rawSegmentFile,mode='wb',compresslevel=6)
+                segmentBytes = 0
+                segmentStartTime = time.time()
+            for rawEntry in entryList:
+                segmentFile.write(rawEntry)
+            segmentBytes += messageBytes
+            publish_batch(workerMetrics,len(entryList),len(entryList),messageBytes,time.time() - writeStartTime,len(entryList),[])
+
+        endTs = readerTs
+        if (readerResumeToken is not None):
+            resumeToken = readerResumeToken
+
+        if (segmentFile is not None) and ((segmentBytes >= appConfig['captureSegmentBytes']) or (time.time() >= (segmentStartTime + appConfig['captureSegmentSeconds'])) or allDone or drainRequested):
+            segmentFile.close()
+            rawSegmentFile.flush()
+            os.fsync(rawSegmentFile.fileno())
+            rawSegmentFile.close()
+            os.replace(segmentFileName + '.tmp',segmentFileName)
+            if appConfig['verboseLogging']:
+                logIt(threadnum,'wrote segment {} with {:,d} bytes of changes'.format(segmentFileName,segmentBytes))
+            segmentFile = None
+            segmentNum += 1
+
+        if (segmentFile is None) and (endTs != "RESUME_TOKEN"):
+            # everything received is in complete segments, the checkpoint can move up to the reader's position
+            publish_position(workerMetrics,endTs,resumeToken)
+
+        if drainRequested:
+            drainQueue.put(threadnum)
+
+    publish_completed(workerMetrics)
+
+
+def file_reader(appConfig, workQueues, workBudgets, drainQueue, activeWorkers):
+    # replays the segment files written by --capture-dir, each entry is routed to the worker that owns its _id exactly as when reading the source
+    if appConfig['verboseLogging']:
+        logIt(-1,'segment file reader started')
+
+    # every started worker is sent the position, only the active ones are routed entries
+    # workQueues and workBudgets hold one list per target, each target has the same number of workers
+    numWorkers = len(workQueues[0])
+    numActiveWorkers = activeWorkers.value
+    partitionOf = get_partitioner(appConfig,numActiveWorkers)
+
+    # a capture can hold more namespaces than are replayed
+    nsPattern = re.compile(get_namespace_pattern(appConfig))
+
+    startTime = time.time()
+
+    allDone = False
+
+    # per-worker entries not yet handed off
+    pendingEntries = [[] for x in range(numWorkers)]
+    pendingBytes = [0 for x in range(numWorkers)]
+
+    handOffSeconds = min(1.0,appConfig["maxSecondsBetweenBatches"])
+    lastHandOff = time.time()
+
+    # entries before the starting position (a checkpoint or --start-position) were already applied
+    startTs = appConfig["startTs"]
+    endTs = appConfig["startTs"]
+    resumeToken = None
+
+    # oplog position of everything before the current ts, the operations of a transaction were captured as several entries with the ts of its commit
+    # hand offs before the end carry this position, so no worker reports the commit before every operation of it is applied
+    prevTs = appConfig["startTs"]
+
+    def get_work_item(workerNum, positionTs):
+        if (appConfig['cdcSource'] == 'oplog'):
+            return (positionTs,pendingEntries[workerNum],pendingBytes[workerNum])
+        return (endTs,resumeToken,pendingEntries[workerNum],pendingBytes[workerNum])
+
+    segmentList = get_segment_files(appConfig['replayDir'],appConfig['cdcSource'])
+    logIt(-1,"replaying {:,d} {} segment files from {}".format(len(segmentList),appConfig['cdcSource'],appConfig['replayDir']))
+
+    for segmentNum, segmentFileName in segmentList:
+        if allDone:
+            break
+
+        if appConfig['verboseLogging']:
+            logIt(-1,"reading segment {}".format(segmentFileName))
+
+        with gzip.open(segmentFileName,'rb') as segmentFile:
+            for doc in bson.decode_file_iter(segmentFile,codec_options=CodecOptions(document_class=RawBSONDocument)):
+                # check if time to exit
+                if ((time.time() - startTime) > appConfig['durationSeconds']) and (appConfig['durationSeconds'] != 0):
+                    allDone = True
+                    break
 
-    perfQ.put({"name":"processCompleted","processNum":threadnum})
+                if (appConfig['cdcSource'] == 'oplog'):
+                    thisTs = doc['ts']
+                    thisNs = doc['ns']
+                    if (doc['op'] in ['i','d']):
+                        docId = get_document_id(doc['o'])
+                    else:
+                        docId = doc['o2']['_id']
+                else:
+                    thisTs = doc['clusterTime']
+                    thisNs = doc['ns']['db']+'.'+doc['ns']['coll']
+                    docId = doc['documentKey']['_id']
+
+                if (thisTs < startTs):
+                    continue
+
+                if (thisTs != endTs):
+                    prevTs = endTs
+                endTs = thisTs
+                if (appConfig['cdcSource'] != 'oplog'):
+                    resumeToken = doc['_id']['_data']
+
+                if (nsPattern.match(thisNs) is not None):
+                    workerNum = partitionOf(docId)
+
+                    pendingEntries[workerNum].append(doc.raw)
+                    pendingBytes[workerNum] += len(doc.raw)
+                    if (len(pendingEntries[workerNum]) >= appConfig["maxOperationsPerBatch"]):
+                        hand_off(workQueues,workBudgets,workerNum,get_work_item(workerNum,prevTs),pendingBytes[workerNum])
+                        pendingEntries[workerNum] = []
+                        pendingBytes[workerNum] = 0
+
+                if (time.time() >= (lastHandOff + handOffSeconds)):
+                    # hand off everything collected so far, every worker gets the current position
+                    for workerNum in range(numWorkers):
+                        hand_off(workQueues,workBudgets,workerNum,get_work_item(workerNum,prevTs),pendingBytes[workerNum],len(pendingEntries[workerNum]) == 0)
+                        pendingEntries[workerNum] = []
+                        pendingBytes[workerNum] = 0
+                    lastHandOff = time.time()
+
+                    if (activeWorkers.value != numActiveWorkers):
+                        # everything up to endTs has been handed off, switch once it is applied
+                        drain_workers(workQueues,workBudgets,drainQueue,numActiveWorkers)
+                        logIt(-1,"changing from {} to {} threads at timestamp {}".format(numActiveWorkers,activeWorkers.value,endTs.as_datetime()))
+                        numActiveWorkers = activeWorkers.value
+                        partitionOf = get_partitioner(appConfig,numActiveWorkers)
+
+    # tell every worker there is nothing more to come
+    for workerNum in range(numWorkers):
+        hand_off(workQueues,workBudgets,workerNum,get_work_item(workerNum,endTs),pendingBytes[workerNum])
+        hand_off(workQueues,workBudgets,workerNum,None,0)
 
 
 def get_resume_token(appConfig):
     logIt(-1,'getting current change stream resume token')
 
     sourceConnection = pymongo.MongoClient(appConfig["sourceUri"])
-    sourceDb = sourceConnection[appConfig["sourceNs"].split('.',1)[0]]
-    sourceColl = sourceDb[appConfig["sourceNs"].split('.',1)[1]]
+    sourceWatch = get_change_stream_source(appConfig,sourceConnection)
 
     allDone = False
 
-    stream = sourceColl.watch()
+    stream = sourceWatch.watch()
 
     while not allDone:
         for change in stream:
@@ -349,7 +1661,45 @@ def get_resume_token(appConfig):
             break
 
 
-def reporter(appConfig, perfQ):
+def get_checkpoint_file(appConfig, targetNum):
+    # with several targets each has its own checkpoint, --checkpoint-file with the target number appended
+    if (len(appConfig['targets']) == 1):
+        return appConfig['checkpointFile']
+    return '{}.{}'.format(appConfig['checkpointFile'],targetNum)
+
+
+def write_checkpoint(appConfig, checkpointFile, checkpointTs, resumeToken):
+    # every operation at or before checkpointTs has been applied by every worker of the target
+    checkpoint = {}
+    checkpoint['cdcSource'] = appConfig['cdcSource']
+    checkpoint['sourceNs'] = appConfig['sourceNs']
+    checkpoint['ts'] = {'t':checkpointTs.time,'i':checkpointTs.inc}
+    checkpoint['resumeToken'] = resumeToken
+    checkpoint['updated'] = datetime.utcnow().isoformat()[:-3] + 'Z'
+
+    # write a temporary file and rename it, a crash mid-write must not destroy the previous checkpoint
+    tempFileName = checkpointFile + '.tmp'
+    with open(tempFileName, 'w') as fp:
+        json.dump(checkpoint, fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tempFileName, checkpointFile)
+
+
+def read_checkpoint(appConfig, checkpointFile):
+    if not os.path.isfile(checkpointFile):
+        return None
+
+    with open(checkpointFile, 'r') as fp:
+        checkpoint = json.load(fp)
+
+    if (checkpoint['cdcSource'] != appConfig['cdcSource']) or (checkpoint['sourceNs'] != appConfig['sourceNs']):
+        sys.exit("\nCheckpoint file {} is for {} using {}, cannot resume {} using {}\n".format(checkpointFile,checkpoint['sourceNs'],checkpoint['cdcSource'],appConfig['sourceNs'],appConfig['cdcSource']))
+
+    return checkpoint
+
+
+def reporter(appConfig, metrics, activeWorkers, txnHold, workerFailed):
     if appConfig['verboseLogging']:
         logIt(-1,'reporting thread started')
     
@@ -359,35 +1709,48 @@ def reporter(appConfig, perfQ):
     lastProcessedOplogEntries = 0
     nextReportTime = startTime + appConfig["feedbackSeconds"]
 
-    resumeToken = 'N/A'
-
     numWorkersCompleted = 0
-    numProcessedOplogEntries = 0
-    
-    dtDict = {}
+
+    # current operations per batch chosen by each worker
+    batchOpsDict = {}
+
+    # end-to-end latency histogram of every worker combined, as of the previous report
+    lastLatencyCounts = [0 for x in range(LATENCY_BUCKETS)]
+
+    # autoscaling state, lag at the previous report and throughput before the last change in threads
+    lastScaleTime = time.time()
+    lastCheckpointSecondsBehind = None
+    scaledFromOpsPerSecond = None
     
-    while (numWorkersCompleted < appConfig["numProcessingThreads"]):
+    # stops early if a worker or the reader exits with an error, the workers never all complete
+    while (numWorkersCompleted < len(metrics)) and (workerFailed.value == 0):
         time.sleep(appConfig["feedbackSeconds"])
         nowTime = time.time()
-        
-        while not perfQ.empty():
-            qMessage = perfQ.get_nowait()
-            if qMessage['name'] == "batchCompleted":
-                numProcessedOplogEntries += qMessage['operations']
-                thisEndDt = qMessage['endts'].as_datetime().replace(tzinfo=None)
-                thisProcessNum = qMessage['processNum']
-                if (thisProcessNum in dtDict) and (thisEndDt > dtDict[thisProcessNum]):
-                    dtDict[thisProcessNum] = thisEndDt
-                else:
-                    dtDict[thisProcessNum] = thisEndDt
-                #print("received endTs = {}".format(thisEndTs.as_datetime()))
-                if 'resumeToken' in qMessage:
-                    resumeToken = qMessage['resumeToken']
-                else:
-                    resumeToken = 'N/A'
 
-            elif qMessage['name'] == "processCompleted":
-                numWorkersCompleted += 1
+        metricsSnapshot = read_metrics(metrics)
+
+        numWorkersCompleted = 0
+        numProcessedOplogEntries = 0
+        numAppliedOperations = 0
+
+        # latest position fully applied by each worker, for checkpointing and how far behind
+        tsDict = {}
+
+        latencyCounts = [0 for x in range(LATENCY_BUCKETS)]
+
+        for thisProcessNum, (thisValues, thisResumeToken) in enumerate(metricsSnapshot):
+            numWorkersCompleted += int(thisValues[METRIC_COMPLETED])
+            numProcessedOplogEntries += int(thisValues[METRIC_OPERATIONS])
+            numAppliedOperations += int(thisValues[METRIC_APPLIED_OPERATIONS])
+            for bucketNum in range(LATENCY_BUCKETS):
+                latencyCounts[bucketNum] += int(thisValues[METRIC_LATENCY + bucketNum])
+            if (thisValues[METRIC_TS_TIME] > 0):
+                tsDict[thisProcessNum] = (Timestamp(int(thisValues[METRIC_TS_TIME]),int(thisValues[METRIC_TS_INC])),thisResumeToken if thisResumeToken != '' else 'N/A')
+            if (thisValues[METRIC_BATCHES] > 0):
+                thisBatchOps = int(thisValues[METRIC_BATCH_OPS])
+                if appConfig['adaptiveBatching'] and appConfig['verboseLogging'] and (batchOpsDict.get(thisProcessNum,thisBatchOps) != thisBatchOps):
+                    logIt(thisProcessNum,'batch size changed from {} to {} operations'.format(batchOpsDict[thisProcessNum],thisBatchOps))
+                batchOpsDict[thisProcessNum] = thisBatchOps
 
         # total total
         elapsedSeconds = nowTime - startTime
@@ -406,14 +1769,85 @@ def reporter(appConfig, perfQ):
         dtUtcNow = datetime.utcnow()
         totSecondsBehind = 0
         numSecondsBehindEntries = 0
-        for thisDt in dtDict:
-            totSecondsBehind = (dtUtcNow - dtDict[thisDt].replace(tzinfo=None)).total_seconds()
+        for thisTs, thisResumeToken in tsDict.values():
+            totSecondsBehind = (dtUtcNow - thisTs.as_datetime().replace(tzinfo=None)).total_seconds()
             numSecondsBehindEntries += 1
 
         avgSecondsBehind = int(totSecondsBehind / max(numSecondsBehindEntries,1))
 
+        # a restart must not begin after the first entry of a transaction that is still being read or applied, checked after the metrics were read
+        if (len(tsDict) == len(metrics)):
+            holdTs = txnHold.get_limit(min(tsDict.values(), key=lambda x: x[0])[0])
+        else:
+            holdTs = txnHold.get_limit(Timestamp(0,0))
+
+        # the safe restart point of each target is its slowest worker, only known once every worker of the target has reported
+        # metrics are laid out target by target, maxProcessingThreads workers each
+        targetsMessage = ""
+        for targetNum in range(len(appConfig['targets'])):
+            targetTsList = [tsDict[workerNum] for workerNum in range(targetNum * appConfig["maxProcessingThreads"],(targetNum + 1) * appConfig["maxProcessingThreads"]) if workerNum in tsDict]
+            if (len(targetTsList) == appConfig["maxProcessingThreads"]):
+                targetTs, targetResumeToken = min(targetTsList, key=lambda x: x[0])
+                if (appConfig['checkpointFile'] is not None):
+                    write_checkpoint(appConfig,get_checkpoint_file(appConfig,targetNum),targetTs if (holdTs is None) else min(targetTs,holdTs),targetResumeToken)
+                if (len(appConfig['targets']) > 1):
+                    targetsMessage += " | target {} {:,d} secs behind".format(targetNum,int((dtUtcNow - targetTs.as_datetime().replace(tzinfo=None)).total_seconds()))
+
+        resumeToken = 'N/A'
+        if (len(tsDict) == len(metrics)):
+            checkpointTs, resumeToken = min(tsDict.values(), key=lambda x: x[0])
+
+            if (appConfig["maxProcessingThreads"] > appConfig["numProcessingThreads"]):
+                checkpointSecondsBehind = (dtUtcNow - checkpointTs.as_datetime().replace(tzinfo=None)).total_seconds()
+                numActiveWorkers = activeWorkers.value
+                newActiveWorkers = numActiveWorkers
+
+                if (nowTime >= (lastScaleTime + appConfig["scaleIntervalSeconds"])) and (lastCheckpointSecondsBehind is not None):
+                    if (checkpointSecondsBehind > appConfig["scaleUpSecondsBehind"]) and (checkpointSecondsBehind >= lastCheckpointSecondsBehind) and (numActiveWorkers < appConfig["maxProcessingThreads"]):
+                        # behind and not catching up, add threads unless the last increase did not raise throughput (the target is the limit)
+                        if (scaledFromOpsPerSecond is None) or (intervalOpsPerSecond > scaledFromOpsPerSecond * 1.1):
+                            newActiveWorkers = min(appConfig["maxProcessingThreads"],numActiveWorkers * 2)
+                    elif (checkpointSecondsBehind < appConfig["scaleDownSecondsBehind"]) and (numActiveWorkers > appConfig["numProcessingThreads"]):
+                        # caught up, give back one thread at a time
+                        newActiveWorkers = numActiveWorkers - 1
+
+                if (newActiveWorkers != numActiveWorkers):
+                    logIt(-1,"{} secs behind at {:,.2f} o/s, changing from {} to {} threads".format(int(checkpointSecondsBehind),intervalOpsPerSecond,numActiveWorkers,newActiveWorkers))
+                    if (newActiveWorkers > numActiveWorkers):
+                        scaledFromOpsPerSecond = intervalOpsPerSecond
+                    else:
+                        scaledFromOpsPerSecond = None
+                    # the readers switch at their next hand off, after every thread has drained
+                    activeWorkers.value = newActiveWorkers
+                    lastScaleTime = nowTime
+
+                lastCheckpointSecondsBehind = checkpointSecondsBehind
+
+        if (appConfig['metricsFile'] is not None):
+            export_metrics(appConfig,metricsSnapshot)
+
+        # end-to-end latency of the operations applied during this interval, source time to target acknowledgement
+        intervalLatencyCounts = [latencyCounts[bucketNum] - lastLatencyCounts[bucketNum] for bucketNum in range(LATENCY_BUCKETS)]
+        lastLatencyCounts = latencyCounts
+        p50Ms, p95Ms, p99Ms, maxMs = get_latency_percentiles(intervalLatencyCounts,[50,95,99,100])
+
+        if (appConfig['latencyFile'] is not None):
+            with open(appConfig['latencyFile'], 'a') as fp:
+                fp.write(json.dumps({'time':datetime.utcnow().isoformat()[:-3] + 'Z','operations':sum(intervalLatencyCounts),'p50Ms':p50Ms,'p95Ms':p95Ms,'p99Ms':p99Ms,'maxMs':maxMs}) + '\n')
+
         logTimeStamp = datetime.utcnow().isoformat()[:-3] + 'Z'
-        print("[{0}] elapsed {1} | total o/s {2:12,.2f} | interval o/s {3:12,.2f} | tot {4:16,d} | {5:12,d} secs behind | resume token = {6}".format(logTimeStamp,thisHMS,totalOpsPerSecond,intervalOpsPerSecond,numProcessedOplogEntries,avgSecondsBehind,resumeToken))
+        if appConfig['adaptiveBatching'] and (len(batchOpsDict) > 0):
+            batchOpsMessage = " | batch ops min {:,d} max {:,d}".format(min(batchOpsDict.values()),max(batchOpsDict.values()))
+        else:
+            batchOpsMessage = ""
+        if appConfig['coalesceOps']:
+            batchOpsMessage += " | applied after coalescing {:,d}".format(numAppliedOperations)
+        if (appConfig["maxProcessingThreads"] > appConfig["numProcessingThreads"]):
+            batchOpsMessage += " | threads {}".format(activeWorkers.value)
+        batchOpsMessage += targetsMessage
+        if (p50Ms is not None):
+            batchOpsMessage += " | latency ms p50 {:,.1f} p95 {:,.1f} p99 {:,.1f} max {:,.1f}".format(p50Ms,p95Ms,p99Ms,maxMs)
+        print("[{0}] elapsed {1} | total o/s {2:12,.2f} | interval o/s {3:12,.2f} | tot {4:16,d} | {5:12,d} secs behind | resume token = {6}{7}".format(logTimeStamp,thisHMS,totalOpsPerSecond,intervalOpsPerSecond,numProcessedOplogEntries,avgSecondsBehind,resumeToken,batchOpsMessage))
         nextReportTime = nowTime + appConfig["feedbackSeconds"]
         
         lastTime = nowTime
@@ -429,24 +1863,41 @@ def main():
                         help='Permit execution on Python 3.6 and prior')
     
     parser.add_argument('--source-uri',
-                        required=True,
+                        required=False,
                         type=str,
-                        help='Source URI')
+                        help='Source URI, not used with --replay-dir')
 
     parser.add_argument('--target-uri',
-                        required=True,
+                        required=False,
                         type=str,
-                        help='Target URI')
+                        action='append',
+                        help='Target URI, repeat to apply the same changes to several targets from a single read of the source, not used with --capture-dir')
 
     parser.add_argument('--source-namespace',
-                        required=True,
+                        required=False,
                         type=str,
-                        help='Source Namespace as <database>.<collection>')
-                        
+                        help='Source Namespace as <database>.<collection>, several as a comma separated list, <database>.* for every collection in a database')
+
+    parser.add_argument('--source-namespace-regex',
+                        required=False,
+                        type=str,
+                        help='Regular expression matching the whole source <database>.<collection> namespace, instead of --source-namespace')
+
     parser.add_argument('--target-namespace',
                         required=False,
                         type=str,
-                        help='Target Namespace as <database>.<collection>, defaults to --source-namespace')
+                        action='append',
+                        help='Target Namespace as <database>.<collection>, defaults to --source-namespace, only valid with a single source namespace, repeat once per --target-uri')
+
+    parser.add_argument('--target-database',
+                        required=False,
+                        type=str,
+                        help='Target database for every source namespace, collection names are kept')
+
+    parser.add_argument('--namespace-map',
+                        required=False,
+                        type=str,
+                        help='Comma separated list of <source-namespace>=<target-namespace>, source namespaces not listed use --target-database or their own name')
                         
     parser.add_argument('--duration-seconds',
                         required=False,
@@ -466,11 +1917,40 @@ def main():
                         default=1,
                         help='Number of threads (parallel processing)')
 
-    parser.add_argument('--max-seconds-between-batches',
+    parser.add_argument('--max-threads',
+                        required=False,
+                        type=int,
+                        help='Maximum number of threads when autoscaling, threads are added while falling behind and removed down to --threads once caught up')
+
+    parser.add_argument('--scale-up-seconds-behind',
+                        required=False,
+                        type=int,
+                        default=60,
+                        help='Seconds behind above which threads are added when using --max-threads')
+
+    parser.add_argument('--scale-down-seconds-behind',
+                        required=False,
+                        type=int,
+                        default=5,
+                        help='Seconds behind below which threads are removed when using --max-threads')
+
+    parser.add_argument('--scale-interval-seconds',
                         required=False,
                         type=int,
+                        default=300,
+                        help='Minimum number of seconds between changes in threads when using --max-threads')
+
+    parser.add_argument('--max-seconds-between-batches',
+                        required=False,
+                        type=float,
                         default=5,
-                        help='Maximum number of seconds to await full batch')
+                        help='Maximum number of seconds to await full batch, fractions allowed')
+
+    parser.add_argument('--max-await-time-ms',
+                        required=False,
+                        type=int,
+                        default=1000,
+                        help='Maximum milliseconds the source waits for new changes before answering an empty oplog or change stream read')
 
     parser.add_argument('--max-operations-per-batch',
                         required=False,
@@ -478,16 +1958,132 @@ def main():
                         default=100,
                         help='Maximum number of operations to include in a single batch')
                         
+    parser.add_argument('--adaptive-batching',
+                        required=False,
+                        action='store_true',
+                        help='Grow or shrink the operations per batch from observed latency, size, and errors, starting at --max-operations-per-batch')
+
+    parser.add_argument('--adaptive-max-operations',
+                        required=False,
+                        type=int,
+                        default=10000,
+                        help='Upper limit on operations per batch when using --adaptive-batching')
+
+    parser.add_argument('--target-batch-ms',
+                        required=False,
+                        type=int,
+                        default=500,
+                        help='Latency each batch should take to apply when using --adaptive-batching')
+
+    parser.add_argument('--max-batch-bytes',
+                        required=False,
+                        type=int,
+                        default=16*1024*1024,
+                        help='Maximum bytes per batch when using --adaptive-batching')
+
+    parser.add_argument('--oplog-batch-size',
+                        required=False,
+                        type=int,
+                        default=0,
+                        help='Number of oplog entries the tailing cursor fetches per round trip, 0 = server default')
+
+    parser.add_argument('--max-queued-bytes',
+                        required=False,
+                        type=int,
+                        default=64*1024*1024,
+                        help='Maximum bytes of changes read from the source and waiting for each thread, reading pauses when reached')
+
+    parser.add_argument('--unordered-apply',
+                        required=False,
+                        action='store_true',
+                        help='Apply each batch as unordered bulk writes, only keeping the order of operations on the same _id')
+
+    parser.add_argument('--coalesce-operations',
+                        required=False,
+                        action='store_true',
+                        help='Collapse multiple operations on the same _id within a batch into the fewest equivalent operations')
+
+    parser.add_argument('--delta-updates',
+                        required=False,
+                        action='store_true',
+                        help='Apply change stream updates as $set/$unset of the changed fields instead of replacing the whole document')
+
+    parser.add_argument('--transactional-apply',
+                        required=False,
+                        action='store_true',
+                        help='Apply each source transaction as a single target transaction when using --use-oplog, the threads pause while it is applied')
+
+    parser.add_argument('--partitioner',
+                        required=False,
+                        type=str,
+                        default='crc32',
+                        choices=['crc32','sha512'],
+                        help='Hash used to assign each _id to a thread')
+
+    parser.add_argument('--raw-passthrough',
+                        required=False,
+                        action='store_true',
+                        help='Apply oplog documents as the raw BSON read from the source without decoding them (change stream documents are always raw)')
+
     parser.add_argument('--dry-run',
                         required=False,
                         action='store_true',
                         help='Read source changes only, do not apply to target')
 
     parser.add_argument('--start-position',
-                        required=True,
+                        required=False,
                         type=str,
                         help='Starting position - 0 for all available changes, YYYY-MM-DD+HH:MM:SS in UTC, or change stream resume token')
 
+    parser.add_argument('--metrics-file',
+                        required=False,
+                        type=str,
+                        help='File to export per thread counters to every --feedback-seconds')
+
+    parser.add_argument('--metrics-format',
+                        required=False,
+                        type=str,
+                        default='prometheus',
+                        choices=['prometheus','json'],
+                        help='Format of --metrics-file, prometheus text (rewritten) or JSON lines (appended)')
+
+    parser.add_argument('--latency-file',
+                        required=False,
+                        type=str,
+                        help='File to append the end-to-end latency percentiles of each --feedback-seconds interval to as JSON lines')
+
+    parser.add_argument('--checkpoint-file',
+                        required=False,
+                        type=str,
+                        help='File to record the position applied by all threads, updated every --feedback-seconds')
+
+    parser.add_argument('--resume',
+                        required=False,
+                        action='store_true',
+                        help='Start from the position in --checkpoint-file, falls back to --start-position if the file does not exist')
+
+    parser.add_argument('--capture-dir',
+                        required=False,
+                        type=str,
+                        help='Write the changes read from the source to compressed segment files in this directory instead of applying them to a target')
+
+    parser.add_argument('--capture-segment-bytes',
+                        required=False,
+                        type=int,
+                        default=256*1024*1024,
+                        help='Uncompressed bytes of changes per segment file when using --capture-dir')
+
+    parser.add_argument('--capture-segment-seconds',
+                        required=False,
+                        type=int,
+                        default=60,
+                        help='Maximum number of seconds a segment file stays open when using --capture-dir, the checkpoint only advances past complete segments')
+
+    parser.add_argument('--replay-dir',
+                        required=False,
+                        type=str,
+                        help='Apply the segment files written by --capture-dir in this directory instead of reading the source, exits once every segment has been applied')
+
     parser.add_argument('--verbose',
                         required=False,
                         action='store_true',
@@ -522,26 +2118,154 @@ def main():
         message = "Cannot supply both --use-oplog or --use-change-stream"
         parser.error(message)
 
-    if (args.use_change_stream) and (args.start_position == "0"):
+    if (args.capture_dir is not None) and (args.replay_dir is not None):
+        message = "Cannot supply both --capture-dir and --replay-dir"
+        parser.error(message)
+
+    if (args.source_uri is None) and (args.replay_dir is None):
+        message = "Must supply --source-uri unless using --replay-dir"
+        parser.error(message)
+
+    if (args.target_uri is None) and (args.capture_dir is None) and (not args.get_resume_token):
+        message = "Must supply --target-uri unless using --capture-dir"
+        parser.error(message)
+
+    if (args.target_uri is not None) and (args.capture_dir is not None):
+        message = "--capture-dir writes changes to files, --target-uri cannot be supplied"
+        parser.error(message)
+
+    if (args.capture_dir is not None) and ((args.threads != 1) or (args.max_threads is not None)):
+        message = "--capture-dir writes every change in order from a single thread, --threads and --max-threads cannot be supplied"
+        parser.error(message)
+
+    if (args.delta_updates) and ((args.capture_dir is not None) or (args.replay_dir is not None)):
+        message = "--delta-updates cannot be used with --capture-dir or --replay-dir, captured updates hold the whole document"
+        parser.error(message)
+
+    if (args.transactional_apply) and ((not args.use_oplog) or (args.capture_dir is not None) or (args.replay_dir is not None)):
+        message = "--transactional-apply requires --use-oplog and cannot be used with --capture-dir or --replay-dir"
+        parser.error(message)
+
+    if (args.replay_dir is not None) and (not os.path.isdir(args.replay_dir)):
+        message = "--replay-dir {} is not a directory".format(args.replay_dir)
+        parser.error(message)
+
+    if (args.replay_dir is not None) and (args.start_position is not None) and (len(args.start_position) == 36):
+        message = "--start-position must be supplied as YYYY-MM-DD+HH:MM:SS in UTC or 0 when using --replay-dir"
+        parser.error(message)
+
+    if (args.source_namespace is None) == (args.source_namespace_regex is None):
+        message = "Must supply exactly one of --source-namespace or --source-namespace-regex"
+        parser.error(message)
+
+    sourceNsList = []
+    if (args.source_namespace is not None):
+        sourceNsList = [thisNs.strip() for thisNs in args.source_namespace.split(',') if thisNs.strip() != '']
+        for thisNs in sourceNsList:
+            if ('.' not in thisNs):
+                message = "Source namespace {} must be <database>.<collection> or <database>.*".format(thisNs)
+                parser.error(message)
+
+    if (args.source_namespace_regex is not None):
+        try:
+            re.compile(args.source_namespace_regex)
+        except re.error as e:
+            message = "--source-namespace-regex is not a valid regular expression: {}".format(e)
+            parser.error(message)
+
+    if (args.target_namespace is not None) and ((len(sourceNsList) != 1) or sourceNsList[0].endswith('.*')):
+        message = "--target-namespace requires a single source collection, use --target-database or --namespace-map"
+        parser.error(message)
+
+    if (args.target_namespace is not None) and (args.target_uri is not None) and (len(args.target_namespace) != len(args.target_uri)):
+        message = "--target-namespace must be supplied once for each --target-uri"
+        parser.error(message)
+
+    namespaceMap = {}
+    if (args.namespace_map is not None):
+        for thisMapping in args.namespace_map.split(','):
+            if (thisMapping.count('=') != 1) or ('.' not in thisMapping.split('=')[1]):
+                message = "--namespace-map entry {} must be <source-namespace>=<target-namespace>".format(thisMapping)
+                parser.error(message)
+            namespaceMap[thisMapping.split('=')[0].strip()] = thisMapping.split('=')[1].strip()
+
+    if (args.max_threads is not None) and (args.max_threads < args.threads):
+        message = "--max-threads cannot be less than --threads"
+        parser.error(message)
+
+    if (args.delta_updates) and (not args.use_change_stream):
+        message = "--delta-updates only applies to --use-change-stream, oplog updates are always applied as updates"
+        parser.error(message)
+
+    if (args.resume) and (args.checkpoint_file is None):
+        message = "--resume requires --checkpoint-file"
+        parser.error(message)
+
+    if (not args.resume) and (args.start_position is None) and (not args.get_resume_token) and (args.replay_dir is None):
+        message = "Must supply --start-position unless using --resume"
+        parser.error(message)
+
+    if (args.use_change_stream) and (args.start_position == "0") and (args.replay_dir is None):
         message = "--start-position must be supplied as YYYY-MM-DD+HH:MM:SS in UTC or resume token when executing in --use-change-stream mode"
         parser.error(message)
 
     appConfig = {}
     appConfig['sourceUri'] = args.source_uri
-    appConfig['targetUri'] = args.target_uri
+    # each target is applied by its own workers, with its own queues and checkpoint
+    # a capture has a single writer in place of a target
+    appConfig['targets'] = []
+    if (args.capture_dir is not None):
+        appConfig['targets'].append({'targetUri':None,'targetNs':None})
+    for targetNum in range(len(args.target_uri or [])):
+        if (args.target_namespace is not None):
+            appConfig['targets'].append({'targetUri':args.target_uri[targetNum],'targetNs':args.target_namespace[targetNum]})
+        else:
+            appConfig['targets'].append({'targetUri':args.target_uri[targetNum],'targetNs':None})
     appConfig['numProcessingThreads'] = args.threads
+    if (args.max_threads is None):
+        appConfig['maxProcessingThreads'] = args.threads
+    else:
+        appConfig['maxProcessingThreads'] = args.max_threads
+    appConfig['scaleUpSecondsBehind'] = args.scale_up_seconds_behind
+    appConfig['scaleDownSecondsBehind'] = args.scale_down_seconds_behind
+    appConfig['scaleIntervalSeconds'] = args.scale_interval_seconds
     appConfig['maxSecondsBetweenBatches'] = args.max_seconds_between_batches
+    appConfig['maxAwaitTimeMs'] = args.max_await_time_ms
     appConfig['maxOperationsPerBatch'] = args.max_operations_per_batch
+    appConfig['adaptiveBatching'] = args.adaptive_batching
+    appConfig['adaptiveMaxOperations'] = args.adaptive_max_operations
+    appConfig['targetBatchMs'] = args.target_batch_ms
+    appConfig['maxBatchBytes'] = args.max_batch_bytes
+    appConfig['oplogBatchSize'] = args.oplog_batch_size
+    appConfig['maxQueuedBytes'] = args.max_queued_bytes
+    appConfig['unorderedApply'] = args.unordered_apply
+    appConfig['coalesceOps'] = args.coalesce_operations
+    appConfig['deltaUpdates'] = args.delta_updates
+    appConfig['transactionalApply'] = args.transactional_apply
+    appConfig['partitioner'] = args.partitioner
     appConfig['durationSeconds'] = args.duration_seconds
     appConfig['feedbackSeconds'] = args.feedback_seconds
+    appConfig['rawPassthrough'] = args.raw_passthrough
     appConfig['dryRun'] = args.dry_run
-    appConfig['sourceNs'] = args.source_namespace
-    if not args.target_namespace:
-        appConfig['targetNs'] = args.source_namespace
+    # sourceNs is the namespace selection as given, it identifies the run in the checkpoint file
+    if (args.source_namespace is not None):
+        appConfig['sourceNs'] = args.source_namespace
     else:
-        appConfig['targetNs'] = args.target_namespace
+        appConfig['sourceNs'] = args.source_namespace_regex
+    appConfig['sourceNsList'] = sourceNsList
+    appConfig['sourceNsRegex'] = args.source_namespace_regex
+    appConfig['targetDatabase'] = args.target_database
+    appConfig['namespaceMap'] = namespaceMap
     appConfig['startPosition'] = args.start_position
     appConfig['verboseLogging'] = args.verbose
+    appConfig['checkpointFile'] = args.checkpoint_file
+    appConfig['metricsFile'] = args.metrics_file
+    appConfig['metricsFormat'] = args.metrics_format
+    appConfig['latencyFile'] = args.latency_file
+    appConfig['captureDir'] = args.capture_dir
+    appConfig['captureSegmentBytes'] = args.capture_segment_bytes
+    appConfig['captureSegmentSeconds'] = args.capture_segment_seconds
+    appConfig['replayDir'] = args.replay_dir
 
     if args.get_resume_token:
         get_resume_token(appConfig)
@@ -552,9 +2276,42 @@ def main():
     else:
         appConfig['cdcSource'] = 'changeStream'
 
-    logIt(-1,"processing {} using {} threads".format(appConfig['cdcSource'],appConfig['numProcessingThreads']))
-
-    if len(appConfig["startPosition"]) == 36:
+    if (appConfig['captureDir'] is not None):
+        logIt(-1,"capturing {} to {}".format(appConfig['cdcSource'],appConfig['captureDir']))
+    elif (appConfig['replayDir'] is not None):
+        logIt(-1,"replaying {} from {} using {} threads".format(appConfig['cdcSource'],appConfig['replayDir'],appConfig['numProcessingThreads']))
+    else:
+        logIt(-1,"processing {} using {} threads".format(appConfig['cdcSource'],appConfig['numProcessingThreads']))
+    if (len(appConfig['targets']) > 1):
+        logIt(-1,"applying to {} targets, each with {} threads".format(len(appConfig['targets']),appConfig['numProcessingThreads']))
+
+    checkpoint = None
+    if args.resume:
+        targetCheckpoints = [read_checkpoint(appConfig,get_checkpoint_file(appConfig,targetNum)) for targetNum in range(len(appConfig['targets']))]
+        if (None in targetCheckpoints) and (targetCheckpoints.count(None) != len(targetCheckpoints)):
+            # starting over from --start-position would skip what the other targets have not applied yet
+            sys.exit("\nCheckpoint file {} does not exist for every target, cannot resume\n".format(get_checkpoint_file(appConfig,targetCheckpoints.index(None))))
+        if (None not in targetCheckpoints):
+            # the single read restarts at the target furthest behind, the others reapply what they already have
+            checkpoint = min(targetCheckpoints, key=lambda x: (x['ts']['t'],x['ts']['i']))
+        if (checkpoint is None) and (appConfig["startPosition"] is None):
+            sys.exit("\nCheckpoint file {} does not exist and no --start-position supplied\n".format(get_checkpoint_file(appConfig,0)))
+        elif (checkpoint is None):
+            logIt(-1,"checkpoint file {} does not exist, using --start-position".format(get_checkpoint_file(appConfig,0)))
+
+    if checkpoint is not None:
+        # restart at the slowest worker's position, anything applied after it by faster workers is replayed
+        appConfig["startTs"] = Timestamp(checkpoint['ts']['t'],checkpoint['ts']['i'])
+
+        logIt(-1,"resuming from checkpoint timestamp = {}".format(appConfig["startTs"].as_datetime()))
+
+    elif (appConfig['replayDir'] is not None) and (appConfig["startPosition"] in [None,"0"]):
+        # every captured change
+        appConfig["startTs"] = Timestamp(0,0)
+
+        logIt(-1,"starting with the first captured change")
+
+    elif len(appConfig["startPosition"]) == 36:
         # resume token
         appConfig["startTs"] = "RESUME_TOKEN"
 
@@ -578,25 +2335,78 @@ def main():
         logIt(-1,"starting with timestamp = {}".format(appConfig["startTs"].as_datetime()))
 
     mp.set_start_method('spawn')
-    q = mp.Manager().Queue()
+    # metrics are laid out target by target, maxProcessingThreads workers each
+    metrics = create_metrics(len(appConfig['targets']) * appConfig["maxProcessingThreads"])
+
+    # number of threads the readers route operations to, changed by the reporter when autoscaling
+    activeWorkers = mp.Value('i',appConfig["numProcessingThreads"])
+
+    # position the checkpoint cannot pass while the oplog reader holds part of a transaction
+    txnHold = TransactionHold()
+
+    # set when any process exits with an error
+    workerFailed = mp.Value('b',0)
 
-    t = threading.Thread(target=reporter,args=(appConfig,q))
+    t = threading.Thread(target=reporter,args=(appConfig,metrics,activeWorkers,txnHold,workerFailed))
     t.start()
     
+    # one reader tails the oplog or change stream and feeds a bounded queue per worker of every target
+    # every thread up to --max-threads is started, threads beyond the active count only receive the position
+    # a slow target fills only its own queues, the reader is held back once one of them reaches --max-queued-bytes
+    workQueues = []
+    workBudgets = []
+    for targetNum in range(len(appConfig['targets'])):
+        workQueues.append([mp.Queue(maxsize=16) for loop in range(appConfig["maxProcessingThreads"])])
+        workBudgets.append([ByteBudget(appConfig["maxQueuedBytes"],workerFailed) for loop in range(appConfig["maxProcessingThreads"])])
+    drainQueue = mp.Queue()
+
     processList = []
-    for loop in range(appConfig["numProcessingThreads"]):
-        if (appConfig['cdcSource'] == 'oplog'):
-            p = mp.Process(target=oplog_processor,args=(loop,appConfig,q))
-        else:
-            p = mp.Process(target=change_stream_processor,args=(loop,appConfig,q))
-        processList.append(p)
+    if (appConfig['replayDir'] is not None):
+        processList.append(mp.Process(target=file_reader,args=(appConfig,workQueues,workBudgets,drainQueue,activeWorkers)))
+    elif (appConfig['cdcSource'] == 'oplog'):
+        processList.append(mp.Process(target=oplog_reader,args=(appConfig,workQueues,workBudgets,drainQueue,activeWorkers,txnHold)))
+    else:
+        processList.append(mp.Process(target=change_stream_reader,args=(appConfig,workQueues,workBudgets,drainQueue,activeWorkers)))
+
+    if (appConfig['captureDir'] is not None):
+        processorTarget = capture_writer
+    elif (appConfig['cdcSource'] == 'oplog'):
+        processorTarget = oplog_processor
+    else:
+        processorTarget = change_stream_processor
+
+    for targetNum, thisTarget in enumerate(appConfig['targets']):
+        # workers only see their own target
+        targetAppConfig = dict(appConfig,**thisTarget)
+        for loop in range(appConfig["maxProcessingThreads"]):
+            workerNum = targetNum * appConfig["maxProcessingThreads"] + loop
+            p = mp.Process(target=processorTarget,args=(workerNum,targetAppConfig,workQueues[targetNum][loop],workBudgets[targetNum][loop],drainQueue,metrics[workerNum]))
+            processList.append(p)
         
     for process in processList:
         process.start()
-        
-    for process in processList:
-        process.join()
-        
+
+    # a process that exits with an error stops the run, otherwise the reader would wait forever on its queue
+    runningList = list(processList)
+    while (len(runningList) > 0) and (workerFailed.value == 0):
+        multiprocessing.connection.wait([process.sentinel for process in runningList])
+        for process in [process for process in runningList if not process.is_alive()]:
+            runningList.remove(process)
+            if (process.exitcode != 0):
+                logIt(-1,"process {} exited with code {}, stopping".format(process.name,process.exitcode))
+                workerFailed.value = 1
+
+    if (workerFailed.value == 1):
+        # the reader stops by itself once it waits on a worker, anything still running after that is stopped
+        stopTime = time.time() + 10
+        for process in runningList:
+            process.join(timeout=max(0.0,stopTime - time.time()))
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        t.join()
+        sys.exit(1)
+
     t.join()
 
 
@@ -3,94 +3,596 @@ import os
 import sys
 import time
 import pymongo
+from bson.raw_bson import RawBSONDocument
 from bson.timestamp import Timestamp
 from bson.objectid import ObjectId
+from bson.int64 import Int64
+from bson.decimal128 import Decimal128
+from bson import json_util
 import threading
+import queue
 import multiprocessing as mp
+import multiprocessing.connection
 import hashlib
+import json
+import bisect
 import argparse
 
 
+# layout of each worker's slot in the shared metrics arrays
+METRIC_OPERATIONS = 0
+METRIC_BYTES = 1
+METRIC_BATCHES = 2
+METRIC_BATCH_OPS = 3
+METRIC_COMPLETED = 4
+METRIC_BATCH_SECONDS = 5
+METRIC_BATCH_LATENCY = 6
+
+# upper bound in milliseconds of each batch latency histogram bucket, one more bucket holds everything slower
+BATCH_LATENCY_BUCKETS_MS = [1,2,5,10,25,50,100,250,500,1000,2500,5000,10000]
+
+METRIC_SLOT_SIZE = METRIC_BATCH_LATENCY + len(BATCH_LATENCY_BUCKETS_MS) + 1
+
+# documents sampled for each segment by --segment-method sample, more gives more even segments
+SAMPLES_PER_SEGMENT = 100
+
+
 def logIt(threadnum, message):
     logTimeStamp = datetime.utcnow().isoformat()[:-3] + 'Z'
     print("[{}] thread {:>3d} | {}".format(logTimeStamp,threadnum,message))
 
 
-def full_load_loader(threadnum, appConfig, perfQ):
+class BatchSizer:
+    # decides how many inserts go into the next bulk_write
+    # fixed at --max-inserts-per-batch unless --adaptive-batching is enabled, then steered by observed latency, size and errors
+
+    def __init__(self, appConfig, initialOps):
+        self.adaptive = appConfig['adaptiveBatching']
+        self.batchOps = initialOps
+        self.minOps = 1
+        if self.adaptive:
+            self.maxOps = max(initialOps,appConfig['adaptiveMaxOperations'])
+        else:
+            self.maxOps = initialOps
+        self.targetSeconds = appConfig['targetBatchMs'] / 1000.0
+        self.maxBytes = appConfig['maxBatchBytes']
+
+    def isFull(self, numOps, numBytes):
+        if (numOps >= self.batchOps):
+            return True
+        return self.adaptive and (numBytes >= self.maxBytes)
+
+    def record(self, numOps, numBytes, elapsedSeconds, failed):
+        # returns True if the batch size changed
+        if not self.adaptive:
+            return False
+
+        previousOps = self.batchOps
+
+        if failed:
+            # target is struggling, back off hard
+            self.batchOps = max(self.minOps, self.batchOps // 2)
+        elif (elapsedSeconds > self.targetSeconds * 1.25):
+            # too slow, scale towards the target latency but never below half
+            scaledOps = int(numOps * self.targetSeconds / elapsedSeconds)
+            self.batchOps = max(self.minOps, self.batchOps // 2, min(self.batchOps, scaledOps))
+        elif (numOps >= self.batchOps) and (elapsedSeconds < self.targetSeconds * 0.75) and (numBytes < self.maxBytes * 0.75):
+            # full batch with headroom on latency and size, grow
+            self.batchOps = min(self.maxOps, int(self.batchOps * 1.25) + 1)
+
+        return (self.batchOps != previousOps)
+
+
+def create_metrics(numWorkers):
+    # one shared array of counters per worker, workers publish into their own slot and the reporter reads them directly
+    metrics = []
+    for x in range(numWorkers):
+        metrics.append(mp.Array('d',METRIC_SLOT_SIZE))
+    return metrics
+
+
+def publish_batch(workerMetrics, numOps, numBytes, batchSeconds, batchOps):
+    with workerMetrics.get_lock():
+        rawValues = workerMetrics.get_obj()
+        rawValues[METRIC_OPERATIONS] += numOps
+        rawValues[METRIC_BYTES] += numBytes
+        rawValues[METRIC_BATCHES] += 1
+        rawValues[METRIC_BATCH_OPS] = batchOps
+        rawValues[METRIC_BATCH_SECONDS] += batchSeconds
+        rawValues[METRIC_BATCH_LATENCY + bisect.bisect_left(BATCH_LATENCY_BUCKETS_MS,batchSeconds * 1000)] += 1
+
+
+def publish_completed(workerMetrics):
+    with workerMetrics.get_lock():
+        workerMetrics.get_obj()[METRIC_COMPLETED] = 1
+
+
+def read_metrics(metrics):
+    # consistent copy of every worker's slot
+    metricsSnapshot = []
+    for workerMetrics in metrics:
+        with workerMetrics.get_lock():
+            metricsSnapshot.append(list(workerMetrics.get_obj()))
+    return metricsSnapshot
+
+
+def export_metrics(appConfig, metricsSnapshot):
+    # snapshot of every worker's counters as Prometheus text (rewritten each time) or JSON lines (appended)
+    if (appConfig['metricsFormat'] == 'json'):
+        workerList = []
+        for workerNum, thisValues in enumerate(metricsSnapshot):
+            workerList.append({'worker':workerNum,
+                               'operations':int(thisValues[METRIC_OPERATIONS]),
+                               'bytes':int(thisValues[METRIC_BYTES]),
+                               'batches':int(thisValues[METRIC_BATCHES]),
+                               'batchOps':int(thisValues[METRIC_BATCH_OPS]),
+                               'batchSeconds':thisValues[METRIC_BATCH_SECONDS],
+                               'completed':bool(thisValues[METRIC_COMPLETED]),
+                               'batchLatencyBucketsMs':BATCH_LATENCY_BUCKETS_MS,
+                               'batchLatencyCounts':[int(x) for x in thisValues[METRIC_BATCH_LATENCY:METRIC_SLOT_SIZE]]})
+        with open(appConfig['metricsFile'], 'a') as fp:
+            fp.write(json.dumps({'time':datetime.utcnow().isoformat()[:-3] + 'Z','workers':workerList}) + '\n')
+
+    else:
+        metricLines = []
+        for metricName, metricType, metricIndex in [('fl_operations_total','counter',METRIC_OPERATIONS),
+                                                    ('fl_bytes_total','counter',METRIC_BYTES),
+                                                    ('fl_batches_total','counter',METRIC_BATCHES),
+                                                    ('fl_batch_operations','gauge',METRIC_BATCH_OPS),
+                                                    ('fl_completed','gauge',METRIC_COMPLETED)]:
+            metricLines.append('# TYPE {} {}'.format(metricName,metricType))
+            for workerNum, thisValues in enumerate(metricsSnapshot):
+                metricLines.append('{}{{worker="{}"}} {}'.format(metricName,workerNum,repr(thisValues[metricIndex])))
+
+        metricLines.append('# TYPE fl_batch_latency_seconds histogram')
+        for workerNum, thisValues in enumerate(metricsSnapshot):
+            cumulativeCount = 0
+            for bucketNum, bucketMs in enumerate(BATCH_LATENCY_BUCKETS_MS + ['+Inf']):
+                cumulativeCount += int(thisValues[METRIC_BATCH_LATENCY + bucketNum])
+                bucketLabel = bucketMs if bucketMs == '+Inf' else repr(bucketMs / 1000)
+                metricLines.append('fl_batch_latency_seconds_bucket{{worker="{}",le="{}"}} {}'.format(workerNum,bucketLabel,cumulativeCount))
+            metricLines.append('fl_batch_latency_seconds_sum{{worker="{}"}} {}'.format(workerNum,repr(thisValues[METRIC_BATCH_SECONDS])))
+            metricLines.append('fl_batch_latency_seconds_count{{worker="{}"}} {}'.format(workerNum,cumulativeCount))
+
+        # write a temporary file and rename it so a scraper never sees a partial file
+        tempFileName = appConfig['metricsFile'] + '.tmp'
+        with open(tempFileName, 'w') as fp:
+            fp.write('\n'.join(metricLines) + '\n')
+        os.replace(tempFileName, appConfig['metricsFile'])
+
+
+def get_id_type_family(docId):
+    # range queries only match _id values of the same BSON type, numbers of any type compare with each other
+    if isinstance(docId,(int,float,Int64,Decimal128)) and not isinstance(docId,bool):
+        return 'number'
+    return type(docId).__name__
+
+
+def get_boundaries(appConfig, numSegments):
+    # returns the _id values splitting the collection into numSegments ranges of about the same number of documents
+    client = pymongo.MongoClient(appConfig['sourceUri'])
+    sourceColl = client[appConfig["sourceNs"].split('.',1)[0]][appConfig["sourceNs"].split('.',1)[1]]
+
+    queryStartTime = time.time()
+
+    firstDoc = sourceColl.find_one(filter=None,projection={"_id":True},sort=[("_id",pymongo.ASCENDING)])
+    lastDoc = sourceColl.find_one(filter=None,projection={"_id":True},sort=[("_id",pymongo.DESCENDING)])
+    if (firstDoc is None) or (numSegments == 1):
+        client.close()
+        return []
+
+    boundaryList = []
+
+    if (appConfig['segmentMethod'] == 'sample'):
+        # random documents, the boundaries are their _id quantiles, sorted by the server so every _id type is ordered as the server orders it
+        sampleIds = [thisDoc['_id'] for thisDoc in sourceColl.aggregate([{'$sample':{'size':numSegments * SAMPLES_PER_SEGMENT}},{'$project':{'_id':True}},{'$sort':{'_id':1}}])]
+        for segmentNum in range(1,numSegments):
+            boundaryList.append(sampleIds[len(sampleIds) * segmentNum // numSegments])
+        typeFamilies = set(get_id_type_family(thisId) for thisId in sampleIds)
+
+    elif (appConfig['segmentMethod'] == 'bucket-auto'):
+        # the server scans the _id index and returns the range of each bucket
+        bucketList = list(sourceColl.aggregate([{'$bucketAuto':{'groupBy':'$_id','buckets':numSegments}}],allowDiskUse=True))
+        for thisBucket in bucketList[:-1]:
+            boundaryList.append(thisBucket['_id']['max'])
+        typeFamilies = set(get_id_type_family(thisBucket['_id']['min']) for thisBucket in bucketList)
+
+    else:
+        # walk the _id index, exact but reads every _id
+        numDocuments = sourceColl.estimated_document_count()
+        segmentDocuments = max(1,numDocuments // numSegments)
+        typeFamilies = set()
+        numDocsSegment = 0
+        for thisDoc in sourceColl.find(filter=None,projection={"_id":True},sort=[("_id",pymongo.ASCENDING)]):
+            numDocsSegment += 1
+            if (numDocsSegment >= segmentDocuments):
+                numDocsSegment = 0
+                boundaryList.append(thisDoc['_id'])
+                typeFamilies.add(get_id_type_family(thisDoc['_id']))
+                if (len(boundaryList) >= numSegments - 1):
+                    break
+
+    client.close()
+
+    typeFamilies.add(get_id_type_family(firstDoc['_id']))
+    typeFamilies.add(get_id_type_family(lastDoc['_id']))
+    if (len(typeFamilies) > 1):
+        sys.exit("\nCollection {} has _id values of several types ({}), ranges cannot be computed, use --boundaries\n".format(appConfig['sourceNs'],', '.join(sorted(typeFamilies))))
+
+    # small collections can sample the same _id more than once
+    uniqueBoundaryList = []
+    for thisBoundary in boundaryList:
+        if (len(uniqueBoundaryList) == 0) or (uniqueBoundaryList[-1] != thisBoundary):
+            uniqueBoundaryList.append(thisBoundary)
+
+    logIt(-1,"computed {} boundaries using {} in {:.1f} seconds".format(len(uniqueBoundaryList),appConfig['segmentMethod'],time.time() - queryStartTime))
+    return uniqueBoundaryList
+
+
+def get_ranges(boundaryList):
+    # (exclusive lower _id, inclusive upper _id) of each range, None = unbounded
+    rangeEdges = [None] + list(boundaryList) + [None]
+    return [(rangeEdges[rangeNum],rangeEdges[rangeNum+1]) for rangeNum in range(len(boundaryList)+1)]
+
+
+def get_range_filter(rangeMin, rangeMax):
+    # query for the _id values after rangeMin up to and including rangeMax
+    idFilter = {}
+    if (rangeMin is not None):
+        idFilter['$gt'] = rangeMin
+    if (rangeMax is not None):
+        idFilter['$lte'] = rangeMax
+    if (len(idFilter) == 0):
+        return {}
+    return {'_id': idFilter}
+
+
+def get_id_distance(lowId, highId):
+    # size of the _id space between two values, None if it cannot be measured for the type
+    if isinstance(lowId,ObjectId) and isinstance(highId,ObjectId):
+        return int.from_bytes(highId.binary,'big') - int.from_bytes(lowId.binary,'big')
+    if (get_id_type_family(lowId) == 'number') and (get_id_type_family(highId) == 'number') and not isinstance(lowId,Decimal128) and not isinstance(highId,Decimal128):
+        return float(highId) - float(lowId)
+    return None
+
+
+def get_split_id(lowId, highId):
+    # _id value half way between two values, None if there is none or it cannot be computed for the type
+    if isinstance(lowId,ObjectId) and isinstance(highId,ObjectId):
+        splitInt = (int.from_bytes(lowId.binary,'big') + int.from_bytes(highId.binary,'big')) // 2
+        splitId = ObjectId(splitInt.to_bytes(12,'big'))
+    elif isinstance(lowId,int) and isinstance(highId,int) and not isinstance(lowId,bool) and not isinstance(highId,bool):
+        splitId = (lowId + highId) // 2
+        if isinstance(lowId,Int64) or isinstance(highId,Int64):
+            splitId = Int64(splitId)
+    elif isinstance(lowId,float) and isinstance(highId,float):
+        splitId = (lowId + highId) / 2
+    else:
+        return None
+    if (lowId < splitId < highId):
+        return splitId
+    return None
+
+
+class RangeQueue:
+    # _id ranges shared by every worker, a worker takes the next range when it finishes one
+    # once none are left an idle worker asks the worker with the most _id space left to split its range, the owner splits at its next batch
+    # so it never gives away _id values it has already read
+
+    def __init__(self, manager, rangeList):
+        self.lock = manager.Lock()
+        self.pending = manager.list(rangeList)
+        # per worker the range being loaded, last _id written, and whether a split was asked for
+        self.active = manager.dict()
+        # set by the main process when a worker exits with an error, its range stays active and would never finish
+        self.workerFailed = mp.Value('b',0)
+
+    def next_range(self, threadnum):
+        # returns (rangeMin, rangeMax) or None once every range has been loaded or a worker has failed
+        while True:
+            if (self.workerFailed.value == 1):
+                return None
+
+            with self.lock:
+                if (len(self.pending) > 0):
+                    thisRange = self.pending.pop(0)
+                    self.active[threadnum] = {'range':thisRange,'position':None,'split':False,'splittable':True}
+                    return thisRange
+
+                if (len(self.active) == 0):
+                    return None
+
+                # the range with the most _id space left, an unbounded one counts as largest
+                largestWorker = None
+                largestDistance = None
+                for workerNum, thisActive in self.active.items():
+                    if thisActive['split'] or (not thisActive['splittable']) or (thisActive['position'] is None):
+                        continue
+                    if (thisActive['range'][1] is None):
+                        thisDistance = float('inf')
+                    else:
+                        thisDistance = get_id_distance(thisActive['position'],thisActive['range'][1])
+                    if (thisDistance is not None) and ((largestDistance is None) or (thisDistance > largestDistance)):
+                        largestWorker = workerNum
+                        largestDistance = thisDistance
+                if (largestWorker is not None):
+                    thisActive = self.active[largestWorker]
+                    thisActive['split'] = True
+                    self.active[largestWorker] = thisActive
+
+            time.sleep(0.1)
+
+    def report(self, threadnum, lastId):
+        # records the last _id written, returns True if another worker is waiting for part of the range
+        with self.lock:
+            thisActive = self.active[threadnum]
+            thisActive['position'] = lastId
+            splitRequested = thisActive['split']
+            thisActive['split'] = False
+            self.active[threadnum] = thisActive
+        return splitRequested
+
+    def split(self, threadnum, splitId):
+        # the worker keeps its range up to splitId, everything after it becomes a new range
+        # splitId None means the rest of the range cannot be split
+        with self.lock:
+            thisActive = self.active[threadnum]
+            if (splitId is None):
+                thisActive['splittable'] = False
+            else:
+                self.pending.append((splitId,thisActive['range'][1]))
+                thisActive['range'] = (thisActive['range'][0],splitId)
+            self.active[threadnum] = thisActive
+
+    def finish(self, threadnum):
+        with self.lock:
+            del self.active[threadnum]
+
+    def num_pending(self):
+        return len(self.pending)
+
+    def remaining(self):
+        # what is left to load, every range not taken yet plus the part of each active range after its last written _id
+        with self.lock:
+            rangeList = list(self.pending)
+            for thisActive in self.active.values():
+                if (thisActive['position'] is None):
+                    rangeList.append(thisActive['range'])
+                else:
+                    rangeList.append((thisActive['position'],thisActive['range'][1]))
+        return rangeList
+
+
+def write_state(appConfig, rangeList):
+    # ranges still to load, as extended JSON so every _id type round trips
+    state = {}
+    state['sourceNs'] = appConfig['sourceNs']
+    state['targetNs'] = appConfig['targetNs']
+    state['ranges'] = [{'min':rangeMin,'max':rangeMax} for rangeMin, rangeMax in rangeList]
+    state['updated'] = datetime.utcnow().isoformat()[:-3] + 'Z'
+
+    # write a temporary file and rename it, a crash mid-write must not destroy the previous state
+    tempFileName = appConfig['stateFile'] + '.tmp'
+    with open(tempFileName, 'w') as fp:
+        fp.write(json_util.dumps(state,json_options=json_util.CANONICAL_JSON_OPTIONS))
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tempFileName, appConfig['stateFile'])
+
+
+def read_state(appConfig):
+    if not os.path.isfile(appConfig['stateFile']):
+        return None
+
+    with open(appConfig['stateFile'], 'r') as fp:
+        state = json_util.loads(fp.read(),json_options=json_util.CANONICAL_JSON_OPTIONS)
+
+    if (state['sourceNs'] != appConfig['sourceNs']) or (state['targetNs'] != appConfig['targetNs']):
+        sys.exit("\nState file {} is for {} to {}, cannot resume {} to {}\n".format(appConfig['stateFile'],state['sourceNs'],state['targetNs'],appConfig['sourceNs'],appConfig['targetNs']))
+
+    return [(thisRange['min'],thisRange['max']) for thisRange in state['ranges']]
+
+
+def write_batch(appConfig, destCollection, docList):
+    bulkOpList = [pymongo.InsertOne(doc) for doc in docList]
+
+    if appConfig['unorderedInserts']:
+        try:
+            destCollection.bulk_write(bulkOpList,ordered=False)
+        except pymongo.errors.BulkWriteError as bwe:
+            # an unordered bulk_write attempts every insert, a duplicate key means the document was already loaded
+            # anything else, including a write concern error, leaves the batch not known to be loaded
+            if (len(bwe.details.get('writeConcernErrors',[])) > 0) or any(writeError['code'] != 11000 for writeError in bwe.details['writeErrors']):
+                raise
+        return
+
+    try:
+        destCollection.bulk_write(bulkOpList,ordered=True)
+    except pymongo.errors.BulkWriteError as bwe:
+        if (len(bwe.details['writeErrors']) == 0):
+            # only the write concern failed, every insert was applied but the batch is not known to be durable
+            raise
+        if (len(bwe.details.get('writeConcernErrors',[])) > 0) or (bwe.details['writeErrors'][0]['code'] != 11000):
+            raise
+        # an ordered bulk_write stops at the first error, everything before it was written
+        # the document already exists (resuming or reloading), send the rest as replaces, built only when needed
+        firstFailedOp = bwe.details['writeErrors'][0]['index']
+        destCollection.bulk_write([pymongo.ReplaceOne({'_id':doc['_id']},doc,upsert=True) for doc in docList[firstFailedOp:]],ordered=True)
+
+
+def prefetch_batches(appConfig, cursor, rangeState, batchSizer, batchQueue):
+    # reads the range and hands complete batches to the writers, so the next batches are read while the current ones are written
+    # rangeState is shared with the writers, which lower the end of the range when another worker takes the rest of it
+    try:
+        batchNum = 0
+        docList = []
+        numCurrentBulkOps = 0
+        numCurrentBulkBytes = 0
+
+        for doc in cursor:
+            docId = doc['_id']
+            with rangeState['lock']:
+                if rangeState['split'] and (docId > rangeState['max']):
+                    # the rest of the range was given to another worker
+                    break
+                rangeState['lastReadId'] = docId
+
+            docList.append(doc)
+            numCurrentBulkOps += 1
+
+            if appConfig['rawPassthrough']:
+                numCurrentBulkBytes += len(doc.raw)
+            else:
+                # documents are decoded by the driver, estimate their size from the collection average
+                numCurrentBulkBytes += appConfig["averageDocumentSize"]
+
+            if batchSizer.isFull(numCurrentBulkOps,numCurrentBulkBytes):
+                batchQueue.put((batchNum,docList,numCurrentBulkOps,numCurrentBulkBytes,docId))
+                batchNum += 1
+                docList = []
+                numCurrentBulkOps = 0
+                numCurrentBulkBytes = 0
+
+        with rangeState['lock']:
+            rangeState['done'] = True
+
+        # the range is complete once its last batch is written
+        if (numCurrentBulkOps > 0):
+            batchQueue.put((batchNum,docList,numCurrentBulkOps,numCurrentBulkBytes,docId))
+
+        for writerNum in range(appConfig['writerThreads']):
+            batchQueue.put(None)
+
+    except Exception as e:
+        # raised again by the worker once its writers stop
+        for writerNum in range(appConfig['writerThreads']):
+            batchQueue.put(e)
+
+
+def write_batches(threadnum, appConfig, destCollection, sourceColl, workerMetrics, rangeQueue, rangeState, batchSizer, batchQueue, rangeProgress):
+    # one of --writer-threads writing the batches of a range, every writer shares the worker's target connection pool
+    # batches finish out of order, the position reported for the range is the last _id of the highest batch with every batch before it written
+    while True:
+        thisBatch = batchQueue.get()
+        if thisBatch is None:
+            break
+        if isinstance(thisBatch,Exception):
+            rangeProgress['errors'].append(thisBatch)
+            break
+        if (len(rangeProgress['errors']) > 0):
+            # another writer failed, keep taking batches so the prefetch thread is not blocked
+            continue
+
+        batchNum, docList, numCurrentBulkOps, numCurrentBulkBytes, lastId = thisBatch
+
+        try:
+            batchStartTime = time.time()
+            batchFailed = False
+            if not appConfig['dryRun']:
+                try:
+                    write_batch(appConfig,destCollection,docList)
+                except (pymongo.errors.AutoReconnect,pymongo.errors.ExecutionTimeout):
+                    # transient failure, retry once and shrink the following batches
+                    batchFailed = True
+                    write_batch(appConfig,destCollection,docList)
+            batchSeconds = time.time() - batchStartTime
+
+            with rangeProgress['lock']:
+                batchSizer.record(numCurrentBulkOps,numCurrentBulkBytes,batchSeconds,batchFailed)
+                publish_batch(workerMetrics,numCurrentBulkOps,numCurrentBulkBytes,batchSeconds,batchSizer.batchOps)
+
+                rangeProgress['written'][batchNum] = lastId
+                lowWaterId = None
+                while rangeProgress['nextBatchNum'] in rangeProgress['written']:
+                    lowWaterId = rangeProgress['written'].pop(rangeProgress['nextBatchNum'])
+                    rangeProgress['nextBatchNum'] += 1
+
+                if (lowWaterId is not None) and rangeQueue.report(threadnum,lowWaterId):
+                    # another worker is idle, give it the second half of what has not been read yet
+                    if (rangeState['max'] is None):
+                        lastDoc = sourceColl.find_one(filter=None,projection={"_id":True},sort=[("_id",pymongo.DESCENDING)])
+                    with rangeState['lock']:
+                        if rangeState['done']:
+                            splitId = None
+                        elif (rangeState['max'] is None):
+                            splitId = get_split_id(rangeState['lastReadId'],lastDoc['_id'])
+                        else:
+                            splitId = get_split_id(rangeState['lastReadId'],rangeState['max'])
+                        if (splitId is not None):
+                            rangeState['max'] = splitId
+                            rangeState['split'] = True
+                    rangeQueue.split(threadnum,splitId)
+                    if (splitId is not None) and appConfig['verboseLogging']:
+                        logIt(threadnum,"split _id range at {}".format(splitId))
+
+        except Exception as e:
+            rangeProgress['errors'].append(e)
+
+
+def full_load_loader(threadnum, appConfig, workerMetrics, rangeQueue):
     if appConfig['verboseLogging']:
         logIt(threadnum,'thread started')
 
-    sourceConnection = pymongo.MongoClient(appConfig["sourceUri"])
+    if appConfig['rawPassthrough']:
+        # documents are copied as the BSON read from the source, without decoding and re-encoding them
+        sourceConnection = pymongo.MongoClient(appConfig["sourceUri"],document_class=RawBSONDocument)
+    else:
+        sourceConnection = pymongo.MongoClient(appConfig["sourceUri"])
     sourceDb = sourceConnection[appConfig["sourceNs"].split('.',1)[0]]
     sourceColl = sourceDb[appConfig["sourceNs"].split('.',1)[1]]
 
-    destConnection = pymongo.MongoClient(appConfig["targetUri"])
+    # shared by every writer thread, the pool has a connection for each
+    destConnection = pymongo.MongoClient(appConfig["targetUri"],maxPoolSize=max(100,appConfig['writerThreads']))
     destDatabase = destConnection[appConfig["targetNs"].split('.',1)[0]]
     destCollection = destDatabase[appConfig["targetNs"].split('.',1)[1]]
 
     startTime = time.time()
     lastFeedback = time.time()
 
-    bulkOpList = []
+    batchSizer = BatchSizer(appConfig,appConfig["maxInsertsPerBatch"])
 
-    # list with replace, not insert, in case document already exists (replaying old oplog)
-    bulkOpListReplace = []
-    numCurrentBulkOps = 0
+    while True:
+        # ranges are taken from the shared queue until every range has been loaded
+        thisRange = rangeQueue.next_range(threadnum)
+        if thisRange is None:
+            break
+        rangeMin, rangeMax = thisRange
 
-    numTotalBatches = 0
+        if appConfig['verboseLogging']:
+            logIt(threadnum,"Creating cursor for _id range {} to {}".format(rangeMin,rangeMax))
 
-    myCollectionOps = 0
+        # in _id order, so the range can be split after the last _id read
+        cursor = sourceColl.find(get_range_filter(rangeMin,rangeMax)).sort('_id',pymongo.ASCENDING)
+        if (appConfig['sourceBatchSize'] > 0):
+            cursor = cursor.batch_size(appConfig['sourceBatchSize'])
 
-    if appConfig['verboseLogging']:
-        logIt(threadnum,"Creating cursor")
-
-    if (threadnum == 0):
-        # thread 0 = $lte only
-        cursor = sourceColl.find({'_id': {'$lte': ObjectId(appConfig['boundaries'][threadnum])}})
-    elif (threadnum == appConfig['numProcessingThreads'] - 1):
-        # last processor = $gt only
-        cursor = sourceColl.find({'_id': {'$gt': ObjectId(appConfig['boundaries'][threadnum-1])}})
-    else:
-        # last processor = $gt prior, $lte next
-        cursor = sourceColl.find({'_id': {'$gt': ObjectId(appConfig['boundaries'][threadnum-1]), '$lte': ObjectId(appConfig['boundaries'][threadnum])}})
+        # one batch waits for each writer, bounding memory per worker
+        rangeState = {'max':rangeMax,'split':False,'done':False,'lastReadId':None,'lock':threading.Lock()}
+        batchQueue = queue.Queue(maxsize=appConfig['writerThreads'])
+        prefetchThread = threading.Thread(target=prefetch_batches,args=(appConfig,cursor,rangeState,batchSizer,batchQueue),daemon=True)
+        prefetchThread.start()
 
-    for doc in cursor:
-        myCollectionOps += 1
-        bulkOpList.append(pymongo.InsertOne(doc))
-        # if playing old oplog, need to change inserts to be replaces (the inserts will fail due to _id uniqueness)
-        #bulkOpListReplace.append(pymongo.ReplaceOne(doc['_id'],doc,upsert=True))
-        numCurrentBulkOps += 1
+        rangeProgress = {'nextBatchNum':0,'written':{},'errors':[],'lock':threading.Lock()}
+        writerList = []
+        for writerNum in range(appConfig['writerThreads']):
+            writerThread = threading.Thread(target=write_batches,args=(threadnum,appConfig,destCollection,sourceColl,workerMetrics,rangeQueue,rangeState,batchSizer,batchQueue,rangeProgress),daemon=True)
+            writerThread.start()
+            writerList.append(writerThread)
 
-        if (numCurrentBulkOps >= appConfig["maxInsertsPerBatch"]):
-            if not appConfig['dryRun']:
-            #    try:
-                result = destCollection.bulk_write(bulkOpList,ordered=True)
-            #    except:
-            #    # replace inserts as replaces
-            #        result = destCollection.bulk_write(bulkOpListReplace,ordered=True)
-            perfQ.put({"name":"batchCompleted","operations":numCurrentBulkOps,"processNum":threadnum})
-            bulkOpList = []
-            bulkOpListReplace = []
-            numCurrentBulkOps = 0
-            numTotalBatches += 1
-
-    if (numCurrentBulkOps > 0):
-        if not appConfig['dryRun']:
-        #    try:
-            result = destCollection.bulk_write(bulkOpList,ordered=True)
-        #    except:
-        #    # replace inserts as replaces
-        #        result = destCollection.bulk_write(bulkOpListReplace,ordered=True)
-        perfQ.put({"name":"batchCompleted","operations":numCurrentBulkOps,"processNum":threadnum})
-        bulkOpList = []
-        bulkOpListReplace = []
-        numCurrentBulkOps = 0
-        numTotalBatches += 1
+        for writerThread in writerList:
+            writerThread.join()
+        prefetchThread.join()
+        cursor.close()
 
-    perfQ.put({"name":"processCompleted","processNum":threadnum})
+        if (len(rangeProgress['errors']) > 0):
+            raise rangeProgress['errors'][0]
 
+        rangeQueue.finish(threadnum)
 
-def reporter(appConfig, perfQ):
+    publish_completed(workerMetrics)
+
+
+def reporter(appConfig, metrics, rangeQueue):
     if appConfig['verboseLogging']:
         logIt(-1,'reporting thread started')
     
@@ -101,18 +603,34 @@ def reporter(appConfig, perfQ):
     nextReportTime = startTime + appConfig["feedbackSeconds"]
     
     numWorkersCompleted = 0
-    numProcessedOplogEntries = 0
+
+    # current inserts per batch chosen by each worker
+    batchOpsDict = {}
     
-    while (numWorkersCompleted < appConfig["numProcessingThreads"]):
+    # stops early if a worker exits with an error, the others never all complete
+    while (numWorkersCompleted < appConfig["numProcessingThreads"]) and (rangeQueue.workerFailed.value == 0):
         time.sleep(appConfig["feedbackSeconds"])
         nowTime = time.time()
-        
-        while not perfQ.empty():
-            qMessage = perfQ.get_nowait()
-            if qMessage['name'] == "batchCompleted":
-                numProcessedOplogEntries += qMessage['operations']
-            elif qMessage['name'] == "processCompleted":
-                numWorkersCompleted += 1
+
+        metricsSnapshot = read_metrics(metrics)
+
+        numWorkersCompleted = 0
+        numProcessedOplogEntries = 0
+
+        for thisProcessNum, thisValues in enumerate(metricsSnapshot):
+            numWorkersCompleted += int(thisValues[METRIC_COMPLETED])
+            numProcessedOplogEntries += int(thisValues[METRIC_OPERATIONS])
+            if (thisValues[METRIC_BATCHES] > 0):
+                thisBatchOps = int(thisValues[METRIC_BATCH_OPS])
+                if appConfig['adaptiveBatching'] and appConfig['verboseLogging'] and (batchOpsDict.get(thisProcessNum,thisBatchOps) != thisBatchOps):
+                    logIt(thisProcessNum,'batch size changed from {} to {} inserts'.format(batchOpsDict[thisProcessNum],thisBatchOps))
+                batchOpsDict[thisProcessNum] = thisBatchOps
+
+        if (appConfig['metricsFile'] is not None):
+            export_metrics(appConfig,metricsSnapshot)
+
+        if (appConfig['stateFile'] is not None):
+            write_state(appConfig,rangeQueue.remaining())
 
         # total total
         elapsedSeconds = nowTime - startTime
@@ -128,12 +646,21 @@ def reporter(appConfig, perfQ):
         intervalOpsPerSecond = (numProcessedOplogEntries - lastProcessedOplogEntries) / intervalElapsedSeconds
 
         logTimeStamp = datetime.utcnow().isoformat()[:-3] + 'Z'
-        print("[{0}] elapsed {1} | total o/s {2:12,.2f} | interval o/s {3:12,.2f} | tot ops {4:16,d}".format(logTimeStamp,thisHMS,totalOpsPerSecond,intervalOpsPerSecond,numProcessedOplogEntries))
+        if appConfig['adaptiveBatching'] and (len(batchOpsDict) > 0):
+            batchOpsMessage = " | batch ops min {:,d} max {:,d}".format(min(batchOpsDict.values()),max(batchOpsDict.values()))
+        else:
+            batchOpsMessage = ""
+        batchOpsMessage += " | ranges pending {:,d}".format(rangeQueue.num_pending())
+        print("[{0}] elapsed {1} | total o/s {2:12,.2f} | interval o/s {3:12,.2f} | tot ops {4:16,d}{5}".format(logTimeStamp,thisHMS,totalOpsPerSecond,intervalOpsPerSecond,numProcessedOplogEntries,batchOpsMessage))
         nextReportTime = nowTime + appConfig["feedbackSeconds"]
         
         lastTime = nowTime
         lastProcessedOplogEntries = numProcessedOplogEntries
 
+    if (rangeQueue.workerFailed.value == 1) and (appConfig['stateFile'] is not None):
+        # the failed worker's range is still active from its last written _id, --resume loads it again
+        write_state(appConfig,rangeQueue.remaining())
+
 
 def main():
     parser = argparse.ArgumentParser(description='Full Load migration tool.')
@@ -175,6 +702,51 @@ def main():
                         default=100,
                         help='Maximum number of inserts to include in a single batch')
                         
+    parser.add_argument('--adaptive-batching',
+                        required=False,
+                        action='store_true',
+                        help='Grow or shrink the inserts per batch from observed latency, size, and errors, starting at --max-inserts-per-batch')
+
+    parser.add_argument('--adaptive-max-operations',
+                        required=False,
+                        type=int,
+                        default=10000,
+                        help='Upper limit on inserts per batch when using --adaptive-batching')
+
+    parser.add_argument('--target-batch-ms',
+                        required=False,
+                        type=int,
+                        default=500,
+                        help='Latency each batch should take to apply when using --adaptive-batching')
+
+    parser.add_argument('--max-batch-bytes',
+                        required=False,
+                        type=int,
+                        default=16*1024*1024,
+                        help='Maximum bytes per batch when using --adaptive-batching')
+
+    parser.add_argument('--unordered-inserts',
+                        required=False,
+                        action='store_true',
+                        help='Send each batch as unordered inserts, documents that already exist (duplicate key) are skipped instead of replaced')
+
+    parser.add_argument('--writer-threads',
+                        required=False,
+                        type=int,
+                        default=1,
+                        help='Number of threads in each worker writing batches concurrently, sharing its target connection pool')
+
+    parser.add_argument('--source-batch-size',
+                        required=False,
+                        type=int,
+                        default=0,
+                        help='Number of documents each source cursor fetches per round trip, 0 = server default')
+
+    parser.add_argument('--raw-passthrough',
+                        required=False,
+                        action='store_true',
+                        help='Copy documents as raw BSON without decoding them, only the _id is read')
+
     parser.add_argument('--dry-run',
                         required=False,
                         action='store_true',
@@ -185,10 +757,50 @@ def main():
                         action='store_true',
                         help='Enable verbose logging')
 
+    parser.add_argument('--metrics-file',
+                        required=False,
+                        type=str,
+                        help='File to export per thread counters to every --feedback-seconds')
+
+    parser.add_argument('--metrics-format',
+                        required=False,
+                        type=str,
+                        default='prometheus',
+                        choices=['prometheus','json'],
+                        help='Format of --metrics-file, prometheus text (rewritten) or JSON lines (appended)')
+
+    parser.add_argument('--state-file',
+                        required=False,
+                        type=str,
+                        help='File to record the _id ranges still to load, updated every --feedback-seconds')
+
+    parser.add_argument('--resume',
+                        required=False,
+                        action='store_true',
+                        help='Continue the ranges in --state-file, documents already written are replaced, starts a new load if the file does not exist')
+
     parser.add_argument('--boundaries',
-                        required=True,
+                        required=False,
                         type=str,
-                        help='Boundaries for segmenting')
+                        help='Comma separated ObjectId boundaries for segmenting, one thread per segment')
+
+    parser.add_argument('--num-workers',
+                        required=False,
+                        type=int,
+                        help='Number of threads, the _id boundaries are computed at startup instead of using --boundaries')
+
+    parser.add_argument('--ranges-per-worker',
+                        required=False,
+                        type=int,
+                        default=4,
+                        help='Number of _id ranges computed for each of --num-workers, workers take ranges from a shared queue and split the largest remaining range when it runs out')
+
+    parser.add_argument('--segment-method',
+                        required=False,
+                        type=str,
+                        default='sample',
+                        choices=['sample','bucket-auto','cursor'],
+                        help='How --num-workers boundaries are computed, $sample (fast, approximate), $bucketAuto (server-side scan), or a cursor over the _id index (exact, slowest)')
 
 
     args = parser.parse_args()
@@ -197,11 +809,39 @@ def main():
     if (not args.skip_python_version_check) and (sys.version_info < MIN_PYTHON):
         sys.exit("\nPython %s.%s or later is required.\n" % MIN_PYTHON)
 
+    if (args.boundaries is None) == (args.num_workers is None):
+        message = "Must supply exactly one of --boundaries or --num-workers"
+        parser.error(message)
+
+    if (args.num_workers is not None) and (args.num_workers < 1):
+        message = "--num-workers must be at least 1"
+        parser.error(message)
+
+    if (args.resume) and (args.state_file is None):
+        message = "--resume requires --state-file"
+        parser.error(message)
+
+    if (args.writer_threads < 1):
+        message = "--writer-threads must be at least 1"
+        parser.error(message)
+
+    if (args.ranges_per_worker < 1):
+        message = "--ranges-per-worker must be at least 1"
+        parser.error(message)
+
     appConfig = {}
     appConfig['sourceUri'] = args.source_uri
     appConfig['targetUri'] = args.target_uri
     appConfig['maxInsertsPerBatch'] = args.max_inserts_per_batch
+    appConfig['adaptiveBatching'] = args.adaptive_batching
+    appConfig['adaptiveMaxOperations'] = args.adaptive_max_operations
+    appConfig['targetBatchMs'] = args.target_batch_ms
+    appConfig['maxBatchBytes'] = args.max_batch_bytes
     appConfig['feedbackSeconds'] = args.feedback_seconds
+    appConfig['rawPassthrough'] = args.raw_passthrough
+    appConfig['sourceBatchSize'] = args.source_batch_size
+    appConfig['unorderedInserts'] = args.unordered_inserts
+    appConfig['writerThreads'] = args.writer_threads
     appConfig['dryRun'] = args.dry_run
     appConfig['sourceNs'] = args.source_namespace
     if not args.target_namespace:
@@ -209,28 +849,85 @@ def main():
     else:
         appConfig['targetNs'] = args.target_namespace
     appConfig['verboseLogging'] = args.verbose
-    appConfig['boundaries'] = args.boundaries.split(',')
-    appConfig['numProcessingThreads'] = len(appConfig['boundaries'])+1
+    appConfig['metricsFile'] = args.metrics_file
+    appConfig['metricsFormat'] = args.metrics_format
+    appConfig['segmentMethod'] = args.segment_method
+    appConfig['stateFile'] = args.state_file
+
+    rangeList = None
+    if args.resume:
+        rangeList = read_state(appConfig)
+        if (rangeList is None):
+            logIt(-1,"state file {} does not exist, starting a new load".format(appConfig['stateFile']))
+        elif (len(rangeList) == 0):
+            sys.exit("\nState file {} shows the load is complete\n".format(appConfig['stateFile']))
+        else:
+            logIt(-1,"resuming {} ranges from state file {}".format(len(rangeList),appConfig['stateFile']))
+
+    if (rangeList is not None):
+        # the ranges in the state file replace the boundaries, only the number of threads is used
+        appConfig['boundaries'] = []
+        if (args.boundaries is not None):
+            appConfig['numProcessingThreads'] = len(args.boundaries.split(','))+1
+        else:
+            appConfig['numProcessingThreads'] = args.num_workers
+    elif (args.boundaries is not None):
+        # one thread per segment, ranges are still split once threads run out of work
+        appConfig['boundaries'] = [ObjectId(thisBoundary.strip()) for thisBoundary in args.boundaries.split(',')]
+        appConfig['numProcessingThreads'] = len(appConfig['boundaries'])+1
+    else:
+        appConfig['boundaries'] = get_boundaries(appConfig,args.num_workers * args.ranges_per_worker)
+        appConfig['numProcessingThreads'] = args.num_workers
     
     logIt(-1,"processing using {} threads".format(appConfig['numProcessingThreads']))
 
+    appConfig["averageDocumentSize"] = 0
+    if appConfig['adaptiveBatching'] and (not appConfig['rawPassthrough']):
+        c = pymongo.MongoClient(appConfig["sourceUri"])
+        collStats = c[appConfig["sourceNs"].split('.',1)[0]].command("collStats",appConfig["sourceNs"].split('.',1)[1])
+        appConfig["averageDocumentSize"] = int(collStats.get('avgObjSize',0))
+        c.close()
+
     mp.set_start_method('spawn')
-    q = mp.Manager().Queue()
+    metrics = create_metrics(appConfig["numProcessingThreads"])
+
+    manager = mp.Manager()
+    if (rangeList is None):
+        rangeList = get_ranges(appConfig['boundaries'])
+    rangeQueue = RangeQueue(manager,rangeList)
 
-    t = threading.Thread(target=reporter,args=(appConfig,q))
+    t = threading.Thread(target=reporter,args=(appConfig,metrics,rangeQueue))
     t.start()
     
     processList = []
     for loop in range(appConfig["numProcessingThreads"]):
-        p = mp.Process(target=full_load_loader,args=(loop,appConfig,q))
+        p = mp.Process(target=full_load_loader,args=(loop,appConfig,metrics[loop],rangeQueue))
         processList.append(p)
         
     for process in processList:
         process.start()
-        
-    for process in processList:
-        process.join()
-        
+
+    # a worker that exits with an error stops the run, otherwise the others would wait forever for its range to finish
+    runningList = list(processList)
+    while (len(runningList) > 0) and (rangeQueue.workerFailed.value == 0):
+        multiprocessing.connection.wait([process.sentinel for process in runningList])
+        for process in [process for process in runningList if not process.is_alive()]:
+            runningList.remove(process)
+            if (process.exitcode != 0):
+                logIt(-1,"process {} exited with code {}, stopping".format(process.name,process.exitcode))
+                rangeQueue.workerFailed.value = 1
+
+    if (rangeQueue.workerFailed.value == 1):
+        # the other workers stop once they ask for another range, anything still running after that is stopped
+        stopTime = time.time() + 10
+        for process in runningList:
+            process.join(timeout=max(0.0,stopTime - time.time()))
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        t.join()
+        sys.exit(1)
+
     t.join()
 
 
@@ -0,0 +1,98 @@
+import sys
+import os
+import time
+import random
+import subprocess
+import importlib.util
+import bson
+from bson.raw_bson import RawBSONDocument
+from bson.objectid import ObjectId
+
+
+# compare the cost and distribution of the cdc-multiprocess.py partitioners, no database required
+
+numIds = 500000
+numThreads = 16
+
+# share of lookups that hit a small set of hot keys
+percentHotKeys = 50
+numHotKeys = 100
+
+
+def loadCdc():
+    cdcPath = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','cdc-multiprocess.py')
+    spec = importlib.util.spec_from_file_location('cdc_multiprocess',cdcPath)
+    cdc = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(cdc)
+    return cdc
+
+
+def buildIds():
+    random.seed(42)
+    hotIds = [ObjectId() for x in range(numHotKeys)]
+    idList = []
+    for x in range(numIds):
+        if random.randint(1,100) <= percentHotKeys:
+            idList.append(random.choice(hotIds))
+        else:
+            idList.append(ObjectId())
+    return idList
+
+
+def buildEmbeddedIds(idList):
+    # embedded document _id values, decoded and as the reader sees them (raw BSON, a new object for every oplog entry)
+    decodedList = [{'tenant':'tenant-{}'.format(x.binary[-1] % 50),'id':x} for x in idList]
+    rawList = [RawBSONDocument(bson.encode(x)) for x in decodedList]
+    return decodedList, rawList
+
+
+def runOne(cdc, partitioner, label, idList):
+    partitionOf = cdc.get_partitioner({"numProcessingThreads":numThreads,"partitioner":partitioner})
+
+    counts = [0] * numThreads
+    startTime = time.time()
+    for thisId in idList:
+        counts[partitionOf(thisId)] += 1
+    elapsedSeconds = time.time() - startTime
+
+    print("{:<8s} {:<12s} | {:12,.0f} ids/s | {:8.3f} secs | per thread min {:8,d} max {:8,d}".format(partitioner,label,len(idList)/elapsedSeconds,elapsedSeconds,min(counts),max(counts)))
+
+
+def checkDeterministic(cdc):
+    # the owning thread must not depend on the interpreter's hash seed
+    fixedIds = ['5f1e9c2a8b3d4e0012345678','5f1e9c2a8b3d4e0012345679','60aa00000000000000000000']
+    code = ("import importlib.util,sys;from bson.objectid import ObjectId;"
+            "spec=importlib.util.spec_from_file_location('c',sys.argv[1]);c=importlib.util.module_from_spec(spec);spec.loader.exec_module(c);"
+            "p=c.get_partitioner({'numProcessingThreads':%d,'partitioner':'crc32'});"
+            "print([p(ObjectId(x)) for x in %r]+[p(12345),p('abc')])") % (numThreads,fixedIds)
+    cdcPath = cdc.__file__
+    results = set()
+    for seed in ['1','2','3']:
+        env = dict(os.environ,PYTHONHASHSEED=seed)
+        results.add(subprocess.run([sys.executable,'-c',code,cdcPath],env=env,capture_output=True,text=True,check=True).stdout.strip())
+    print("crc32 assignments identical across hash seeds = {}".format(len(results) == 1))
+
+
+def main():
+    cdc = loadCdc()
+    idList = buildIds()
+
+    print("{:,d} ObjectIds, {} threads, {} percent of lookups on {} hot keys".format(numIds,numThreads,percentHotKeys,numHotKeys))
+    print("")
+    runOne(cdc,'sha512','ObjectId',idList)
+    runOne(cdc,'crc32','ObjectId',idList)
+
+    decodedList, rawList = buildEmbeddedIds(idList)
+    runOne(cdc,'sha512','embedded',decodedList)
+    runOne(cdc,'crc32','embedded',decodedList)
+    runOne(cdc,'crc32','embedded raw',rawList)
+    print("")
+
+    # raw embedded _id values must go to the same thread as when they are encoded
+    partitionOf = cdc.get_partitioner({"numProcessingThreads":numThreads,"partitioner":'crc32'})
+    print("crc32 raw and decoded embedded assignments identical = {}".format(all(partitionOf(x) == partitionOf(y) for x, y in zip(decodedList,rawList))))
+    checkDeterministic(cdc)
+
+
+if __name__ == "__main__":
+    main()
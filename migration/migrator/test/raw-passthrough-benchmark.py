@@ -0,0 +1,86 @@
+import os
+import time
+import random
+import string
+import importlib.util
+import bson
+from bson.raw_bson import RawBSONDocument
+from bson.objectid import ObjectId
+
+
+# compare copying documents decoded to dicts against raw BSON passthrough (--raw-passthrough), no database required
+# each document is decoded as the driver would on read, then encoded as the driver would for InsertOne
+
+numDocs = 2000
+
+# approximate document sizes to test, in bytes
+docSizes = [1024, 16*1024, 256*1024]
+
+
+def loadCdc():
+    cdcPath = os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','cdc-multiprocess.py')
+    spec = importlib.util.spec_from_file_location('cdc_multiprocess',cdcPath)
+    cdc = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(cdc)
+    return cdc
+
+
+def buildDoc(docSize):
+    # mix of scalars, strings, an embedded document, and an array, repeated until the document is large enough
+    thisDoc = {'_id':ObjectId()}
+    fieldNum = 0
+    thisSize = len(bson.encode(thisDoc))
+    while thisSize < docSize:
+        thisField = {'name':''.join(random.choice(string.ascii_letters) for x in range(32)),
+                     'count':random.randint(0,1000000),
+                     'ratio':random.random(),
+                     'tags':[random.randint(0,100) for x in range(10)],
+                     'created':ObjectId().generation_time}
+        thisDoc['f{}'.format(fieldNum)] = thisField
+        thisSize += len(bson.encode({'f{}'.format(fieldNum):thisField})) - 5
+        fieldNum += 1
+    return bson.encode(thisDoc)
+
+
+def runOne(cdc, description, rawDocs, copyDoc):
+    numBytes = 0
+    startTime = time.time()
+    for rawDoc in rawDocs:
+        numBytes += len(copyDoc(cdc,rawDoc))
+    elapsedSeconds = time.time() - startTime
+
+    print("{:<12s} | {:10,.0f} docs/s | {:10,.1f} MB/s | {:8.3f} secs".format(description,len(rawDocs)/elapsedSeconds,numBytes/elapsedSeconds/1024/1024,elapsedSeconds))
+
+
+def copyDict(cdc, rawDoc):
+    doc = bson.decode(rawDoc)
+    # partitioning reads the _id
+    docId = doc['_id']
+    return bson.encode(doc)
+
+
+def copyRaw(cdc, rawDoc):
+    doc = RawBSONDocument(rawDoc)
+    # partitioning reads the _id, the same way the oplog reader does
+    docId = cdc.get_document_id(doc)
+    return bson.encode(doc)
+
+
+def main():
+    cdc = loadCdc()
+
+    random.seed(42)
+
+    for docSize in docSizes:
+        rawDocs = [buildDoc(docSize) for x in range(max(numDocs * 1024 // docSize, 50))]
+        print("{:,d} documents of about {:,d} bytes".format(len(rawDocs),docSize))
+        runOne(cdc,'dict',rawDocs,copyDict)
+        runOne(cdc,'raw',rawDocs,copyRaw)
+
+        # both paths must write exactly what was read
+        print("identical output = {}".format(all(copyDict(cdc,rawDoc) == rawDoc and copyRaw(cdc,rawDoc) == rawDoc for rawDoc in rawDocs)))
+        print("")
+
+
+if __name__ == "__main__":
+    main()